@@ -0,0 +1,75 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Number of files fetched at the same time
+fetch_workers = 8
+
+# Seconds to wait for a connection, and then between bytes received
+fetch_timeout = (5, 30)
+
+# Files larger than this are skipped
+fetch_max_size = 50 * 1024 * 1024
+
+fetch_chunk_size = 64 * 1024
+
+
+def create_session() -> requests.Session:
+    # One connection per worker, kept open between files from the same host
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=fetch_workers, pool_maxsize=fetch_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch(session: requests.Session, url: str) -> Optional[bytes]:
+    """
+    Returns the content of the URL, or None if it could not be fetched or is
+    larger than fetch_max_size.
+    """
+    try:
+        with session.get(url, timeout=fetch_timeout, stream=True) as response:
+            if response.status_code != 200:
+                logger.warning('Fetching {0} failed with status {1}'.format(url, response.status_code))
+                return None
+
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and int(content_length) > fetch_max_size:
+                logger.warning('Skipped {0}: {1} bytes is over the size limit'.format(url, content_length))
+                return None
+
+            # The length header is optional, so also count what is received
+            content = bytearray()
+            for chunk in response.iter_content(fetch_chunk_size):
+                content.extend(chunk)
+                if len(content) > fetch_max_size:
+                    logger.warning('Skipped {0}: over the size limit'.format(url))
+                    return None
+
+            return bytes(content)
+    except requests.RequestException as e:
+        logger.warning('Fetching {0} failed: {1}'.format(url, e))
+        return None
+
+
+def fetch_all(urls: Iterable[str]) -> dict:
+    """
+    Fetches the URLs concurrently, and returns their content by URL (None for
+    those that could not be fetched). Each URL is fetched once.
+    """
+    urls = list(dict.fromkeys(urls))
+    if len(urls) == 0:
+        return {}
+
+    with create_session() as session, ThreadPoolExecutor(max_workers=min(fetch_workers, len(urls))) as executor:
+        contents = executor.map(lambda url: fetch(session, url), urls)
+        return dict(zip(urls, contents))
@@ -3,11 +3,12 @@
 
 import os
 import io
-import requests
 import enum
+from typing import Iterator, List, NamedTuple
 from urllib.parse import urljoin
 
 from django.db import transaction
+from django.db.models import prefetch_related_objects
 from django.core.files import File
 from django.core.files.images import ImageFile
 from django.conf import settings
@@ -16,7 +17,9 @@ import gpxpy
 import gpxpy.gpx
 import gpxpy.gpxfield
 
-from .models import Activity, MediaType, WaypointGroup, Waypoint, ActivityType, WaypointMedia, WaypointGroupType
+from .models import Activity, MediaType, WaypointGroup, Waypoint, ActivityType, WaypointMedia, WaypointGroupType, activity_graph_lookup, \
+    blobStorageName, claim_files, delete_unreferenced_file
+from .fetch_utils import fetch_all
 
 try:
     # Load LXML or fallback to cET or ET
@@ -57,7 +60,25 @@ class WaypointType(enum.Enum):
     routePoint = 2
     trackPoint = 3
 
+
+class MediaLink(NamedTuple):
+    url: str
+    type: MediaType
+    mime_type: str
+    description: str
+
+
 def activity_to_gpx(activity: Activity) -> str:
+    return ''.join(activity_to_gpx_chunks(activity))
+
+
+def activity_to_gpx_chunks(activity: Activity) -> Iterator[str]:
+    """
+    Yields the activity's GPX document a piece at a time: the metadata, then
+    one chunk per waypoint. The output is identical to building the whole
+    gpxpy document and calling to_xml(), but only one waypoint is held as a
+    gpxpy object at a time, and the document is never held as one string.
+    """
     if activity.type == ActivityType.ORIENTEERING:
         version = GPXVersion.v1
     else:
@@ -121,33 +142,50 @@ def activity_to_gpx(activity: Activity) -> str:
 
     gpx.metadata_extensions.append(gpxsc_meta)
 
+    # Load all groups, waypoints and media in one query per level, rather
+    # than several queries per waypoint (no-op if already prefetched)
+    prefetch_related_objects([activity], activity_graph_lookup)
+    waypoints_group = activity.waypoints_group
+    pois_group = activity.pois_group
+
+    # Serialize the document without waypoints or routes, and stream them
+    # in before the closing tag. GPX waypoints precede GPX routes.
+    document = gpx.to_xml()
+    document_end = '\n</gpx>'
+    yield document[:-len(document_end)]
+
+    def gpx_element(element, tag, indent):
+        return gpxpy.gpxfield.gpx_fields_to_xml(element, tag, gpx.version, nsmap=gpx.nsmap, indent=indent)
+
     if version == GPXVersion.v1:
         # Waypoints
-        if activity.waypoints_group is not None:
-            waypoints = activity.waypoints_group.waypoints
+        if waypoints_group is not None:
+            waypoints = waypoints_group.waypoints
             for waypoint in waypoints:
                 gpx_wps = waypoint_to_gpx(waypoint)
-                gpx.waypoints.append(gpx_wps)
+                yield gpx_element(gpx_wps, 'wpt', '  ')
     else:
+        # POIs
+        if pois_group is not None:
+            pois = pois_group.waypoints
+            for poi in pois:
+                gpx_wps = waypoint_to_gpx(poi, type=WaypointType.waypoint)
+                yield gpx_element(gpx_wps, 'wpt', '  ')
+
         # Waypoints
-        if activity.waypoints_group is not None:
-            gpx_rte = gpxpy.gpx.GPXRoute()
+        if waypoints_group is not None:
+            route = gpx_element(gpxpy.gpx.GPXRoute(), 'rte', '  ')
+            route_end = '\n  </rte>'
+            yield route[:-len(route_end)]
 
-            waypoints = activity.waypoints_group.waypoints
+            waypoints = waypoints_group.waypoints
             for waypoint in waypoints:
                 gpx_rtept = waypoint_to_gpx(waypoint, type=WaypointType.routePoint)
-                gpx_rte.points.append(gpx_rtept)
+                yield gpx_element(gpx_rtept, 'rtept', '    ')
 
-            gpx.routes.append(gpx_rte)
+            yield route_end
 
-        # POIs
-        if activity.pois_group is not None:
-            pois = activity.pois_group.waypoints
-            for poi in pois:
-                gpx_wps = waypoint_to_gpx(poi, type=WaypointType.waypoint)
-                gpx.waypoints.append(gpx_wps)
-
-    return gpx.to_xml()
+    yield document_end
 
 # TODO: Import the new v2 scheme
 
@@ -215,7 +253,6 @@ def waypoint_to_gpx(waypoint: Waypoint, type: WaypointType = WaypointType.waypoi
     return gpx_wps
 
 
-@transaction.atomic
 def gpx_to_activity(gpx_file: str, user) -> Activity:
     user_id = user.id
     if user_id is None:
@@ -251,17 +288,9 @@ def gpx_to_activity(gpx_file: str, user) -> Activity:
         activity.updated = gpx.time
 
     # Image
+    image_url = None
     if gpx.link and gpx.link_type == 'image':
-        # Wait for image to download...
-        link = urljoin(settings.FILE_UPLOAD_BASE_URL, gpx.link)
-        image_response = requests.get(link)
-
-        if image_response.status_code == 200 and image_response.content != None:
-            filename = os.path.basename(gpx.link)
-            activity.image = ImageFile(io.BytesIO(image_response.content), name=filename)
-
-            if gpx.link_text:
-                activity.image_alt = gpx.link_text
+        image_url = urljoin(settings.FILE_UPLOAD_BASE_URL, gpx.link)
 
     # Metadata extensions
     gpxsc_meta = next((e for e in gpx.metadata_extensions if e.tag == (GPXSC_NS_FULL + 'meta')), None)
@@ -286,34 +315,83 @@ def gpx_to_activity(gpx_file: str, user) -> Activity:
             elif sub_element.tag == GPXSC_NS_FULL + 'version':
                 version = GPXVersion(int(sub_element.text))
 
-    activity.save()
-
     # Waypoint Groups
     waypoints_group = WaypointGroup(activity=activity, name='Default', type=WaypointGroupType.ORDERED)
-    waypoints_group.save()
-
     pois_group = WaypointGroup(activity=activity, name='Points of Interest', type=WaypointGroupType.UNORDERED)
-    pois_group.save()
+
+    # Waypoints, with the links to their media
+    waypoints = []
 
     if version == GPXVersion.v1:
         # Waypoints
-        if len(gpx.waypoints) > 0:
-            for index, gpx_waypoint in enumerate(gpx.waypoints):
-                waypoint = gpx_to_waypoint(gpx_waypoint, waypoints_group)
-                waypoint.index = index
-                waypoint.save()
+        for index, gpx_waypoint in enumerate(gpx.waypoints):
+            waypoint = gpx_to_waypoint(gpx_waypoint, waypoints_group)
+            waypoint.index = index
+            waypoints.append((waypoint, gpx_to_media_links(gpx_waypoint)))
     else:
         # Waypoints
         if len(gpx.routes) > 0:
             for index, gpx_route_point in enumerate(gpx.routes[0].points):
                 waypoint = gpx_to_waypoint(gpx_route_point, waypoints_group)
                 waypoint.index = index
-                waypoint.save()
+                waypoints.append((waypoint, gpx_to_media_links(gpx_route_point)))
         # POIs
-        if len(gpx.waypoints) > 0:
-            for index, gpx_waypoint in enumerate(gpx.waypoints):
-                waypoint = gpx_to_waypoint(gpx_waypoint, pois_group)
-                waypoint.save()
+        for gpx_waypoint in gpx.waypoints:
+            waypoint = gpx_to_waypoint(gpx_waypoint, pois_group)
+            waypoints.append((waypoint, gpx_to_media_links(gpx_waypoint)))
+
+    # Download all media before any row is written, so that no transaction
+    # is held open while waiting on the network
+    urls = [image_url] if image_url else []
+    urls += [link.url for _, links in waypoints for link in links]
+    contents = fetch_all(urls)
+
+    # Files to store, as (field file, content)
+    files = []
+
+    if image_url and contents.get(image_url) != None:
+        filename = os.path.basename(gpx.link)
+        files.append((activity.image, ImageFile(io.BytesIO(contents[image_url]), name=filename)))
+
+        if gpx.link_text:
+            activity.image_alt = gpx.link_text
+
+    waypoint_media_items = []
+    for waypoint, links in waypoints:
+        for link in links:
+            content = contents.get(link.url)
+            if content == None:
+                continue
+
+            filename = os.path.basename(link.url)
+            waypoint_media = WaypointMedia(waypoint=waypoint,
+                                           type=link.type,
+                                           mime_type=link.mime_type,
+                                           description=link.description)
+            files.append((waypoint_media.media, File(io.BytesIO(content), name=filename)))
+            waypoint_media_items.append(waypoint_media)
+
+    # Claim the files in one query, rather than one per file as
+    # FieldFile.save() would
+    names = [blobStorageName(content, content.name) for _, content in files]
+    claim_files(names)
+    for (file, content), name in zip(files, names):
+        file.store(name, content)
+
+    # One insert per model, whatever the number of waypoints. bulk_create()
+    # does not send pre_save, and saving the activity already marks it as
+    # having unpublished changes.
+    try:
+        with transaction.atomic():
+            activity.save()
+            WaypointGroup.objects.bulk_create([waypoints_group, pois_group])
+            Waypoint.objects.bulk_create([waypoint for waypoint, _ in waypoints])
+            WaypointMedia.objects.bulk_create(waypoint_media_items)
+    except:
+        # Files stored for the import, unless something else refers to them
+        for file, _ in files:
+            delete_unreferenced_file(file)
+        raise
 
     return activity
 
@@ -334,44 +412,37 @@ def gpx_to_waypoint(gpx_waypoint: gpxpy.gpx.GPXWaypoint, waypoint_group: Waypoin
             elif sub_element.attrib.get('type') == 'departure':
                 activity_waypoint.departure_callout = sub_element.text
 
-    gpxsc_links = next((e for e in gpx_waypoint.extensions if e.tag == (GPXSC_NS_FULL + 'links')), None)
+    return activity_waypoint
 
-    # Waypoint Media
-    if gpxsc_links != None:
-        activity_waypoint.save()
 
-        for gpxsc_link in gpxsc_links:
-            href = gpxsc_link.attrib.get('href')
-            if href == None:
-                continue
+def gpx_to_media_links(gpx_waypoint: gpxpy.gpx.GPXWaypoint) -> List[MediaLink]:
+    gpxsc_links = next((e for e in gpx_waypoint.extensions if e.tag == (GPXSC_NS_FULL + 'links')), None)
+    if gpxsc_links == None:
+        return []
 
-            href = urljoin(settings.FILE_UPLOAD_BASE_URL, href)
-            media_response = requests.get(href)
+    links = []
 
-            if media_response.status_code != 200 or media_response.content == None:
-                continue
+    for gpxsc_link in gpxsc_links:
+        href = gpxsc_link.attrib.get('href')
+        if href == None:
+            continue
 
-            filename = os.path.basename(href)
-            media = File(io.BytesIO(media_response.content), name=filename)
+        mime_type_element = next((e for e in gpxsc_link if e.tag == 'type'), None)
+        if mime_type_element == None:
+            continue
 
-            mime_type_element = next((e for e in gpxsc_link if e.tag == 'type'), None)
-            if mime_type_element == None:
-                continue
-
-            if mime_type_element.text.startswith('image'):
-                type = MediaType.IMAGE
-            elif mime_type_element.text.startswith('audio'):
-                type = MediaType.AUDIO
-            else:
-                continue
+        if mime_type_element.text.startswith('image'):
+            type = MediaType.IMAGE
+        elif mime_type_element.text.startswith('audio'):
+            type = MediaType.AUDIO
+        else:
+            continue
 
-            description_element = next((e for e in gpxsc_link if e.tag == 'text'), None)
+        description_element = next((e for e in gpxsc_link if e.tag == 'text'), None)
 
-            waypoint_media = WaypointMedia(waypoint=activity_waypoint,
-                                           media=media,
-                                           type=type,
-                                           mime_type=mime_type_element.text,
-                                           description=description_element.text)
-            waypoint_media.save()
+        links.append(MediaLink(url=urljoin(settings.FILE_UPLOAD_BASE_URL, href),
+                               type=type,
+                               mime_type=mime_type_element.text,
+                               description=description_element.text))
 
-    return activity_waypoint
+    return links
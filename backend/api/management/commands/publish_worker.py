@@ -0,0 +1,48 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections
+
+from api.models import sweep_unreferenced_files
+from api.publish_utils import requeue_stale_jobs, run_next_job
+
+
+class Command(BaseCommand):
+    help = 'Runs queued activity publish jobs, and deletes media files no longer referred to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=float, default=2, help='seconds to wait when the queue is empty')
+        parser.add_argument('--stale_after', type=int, default=600,
+                            help='seconds without a heartbeat after which a running job is assumed abandoned and queued again')
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        stale_after = timedelta(seconds=options['stale_after'])
+
+        while True:
+            # Drop connections that were closed or have outlived CONN_MAX_AGE,
+            # as a request would at its start and end
+            close_old_connections()
+
+            try:
+                requeued = requeue_stale_jobs(stale_after)
+                if requeued:
+                    self.stdout.write('Requeued {0} stale publish jobs'.format(requeued))
+
+                while run_next_job():
+                    pass
+
+                sweep_unreferenced_files()
+            except DatabaseError as e:
+                if options['once']:
+                    raise
+                self.stderr.write('Publish worker database error: {0}'.format(e))
+
+            if options['once']:
+                return
+
+            time.sleep(options['poll'])
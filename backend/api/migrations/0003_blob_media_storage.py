@@ -0,0 +1,24 @@
+# Generated by Django 4.0.8 on 2026-10-19 01:36
+
+import api.models
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_publishjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activity',
+            name='image',
+            field=api.models.BlobImageField(blank=True, null=True, upload_to=api.models.activityImageStorageName),
+        ),
+        migrations.AlterField(
+            model_name='waypointmedia',
+            name='media',
+            field=api.models.BlobFileField(upload_to=api.models.waypointMediaStorageName),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.8 on 2026-10-19 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_blob_media_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='publishjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
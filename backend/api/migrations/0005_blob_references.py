@@ -0,0 +1,39 @@
+# Generated by Django 4.0.8 on 2026-10-19 01:53
+
+import api.models
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_publishjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreferencedFile',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('name', models.TextField(unique=True)),
+                ('recorded', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.AlterField(
+            model_name='activity',
+            name='image',
+            field=api.models.BlobImageField(blank=True, db_index=True, null=True, upload_to=api.models.activityImageStorageName),
+        ),
+        migrations.AlterField(
+            model_name='waypointmedia',
+            name='media',
+            field=api.models.BlobFileField(db_index=True, upload_to=api.models.waypointMediaStorageName),
+        ),
+    ]
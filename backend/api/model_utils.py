@@ -1,15 +1,26 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from .models import Activity, WaypointGroup, Waypoint, WaypointMedia
+import uuid
+
+from .models import Activity, WaypointGroup, Waypoint, WaypointMedia, mark_activity_dirty
 from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
 
 
 @transaction.atomic
 def duplicate_activity(activity: Activity) -> Activity:
-    waypoint_groups = activity.waypoint_groups_all
-
-    # TODO: duplicate featured image
+    """
+    Copies the activity with all of its groups, waypoints and media, using
+    one bulk insert per model. bulk_create() does not send pre_save, so the
+    copy is only marked as having unpublished changes once, when it is saved.
+    """
+    waypoint_groups = list(activity.waypoint_groups_all)
+    waypoints = list(Waypoint.objects.filter(group__activity=activity))
+    waypoint_media_items = list(WaypointMedia.objects.filter(waypoint__group__activity=activity))
+
+    # The featured image and media files are shared with the original, and
+    # only deleted once neither refers to them (see BlobFileMixin)
     activity.name = '{} copy'.format(activity.name)
     activity.pk = None
     activity.id = None
@@ -18,55 +29,71 @@ def duplicate_activity(activity: Activity) -> Activity:
     activity._state.adding = True
     activity.save()
 
-    for group in waypoint_groups.iterator():
-        duplicate_waypoint_group(group=group, activity=activity)
+    group_ids = {}
+    for group in waypoint_groups:
+        original_id = group.id
+        group_ids[original_id] = duplicate_id(group)
+        group.activity = activity
+    WaypointGroup.objects.bulk_create(waypoint_groups)
+
+    waypoint_ids = {}
+    for waypoint in waypoints:
+        original_id = waypoint.id
+        waypoint_ids[original_id] = duplicate_id(waypoint)
+        waypoint.group_id = group_ids[waypoint.group_id]
+    Waypoint.objects.bulk_create(waypoints)
+
+    for waypoint_media in waypoint_media_items:
+        duplicate_id(waypoint_media)
+        waypoint_media.waypoint_id = waypoint_ids[waypoint_media.waypoint_id]
+    WaypointMedia.objects.bulk_create(waypoint_media_items)
 
     return activity
 
 
-@transaction.atomic
-def duplicate_waypoint_group(group: WaypointGroup, activity: Activity):
-    waypoints = group.waypoints
+def duplicate_id(instance) -> uuid.UUID:
+    # Give a loaded row a new primary key, so that saving it inserts a copy
+    instance.id = uuid.uuid4()
+    instance._state.adding = True
+    return instance.id
 
-    group.activity = activity
-    group.pk = None
-    group.id = None
-    group._state.adding = True
-    group.save()
 
-    for waypoint in waypoints.iterator():
-        duplicate_waypoint(waypoint=waypoint, group=group)
+# Indexes are rewritten in two UPDATEs: first to distinct negative values, then
+# to their final values, so that the unique_group_index constraint holds after
+# every row whatever order the database updates them in.
 
-# TODO: support waypoint media
+@transaction.atomic
+def shift_waypoints_after_delete(group: WaypointGroup, deleted_index: int):
+    waypoints = Waypoint.objects.filter(group=group)
 
+    # Decrease the index of all waypoints after the deleted index
+    waypoints.filter(index__gt=deleted_index).update(index=-F('index'))
+    waypoints.filter(index__lt=0).update(index=-F('index') - 1)
 
-def duplicate_waypoint(waypoint: Waypoint, group: WaypointGroup):
-    waypoint_media_items = waypoint.media_items
+    mark_activity_dirty(activity_id=group.activity_id)
 
-    waypoint.group = group
-    waypoint.pk = None
-    waypoint.id = None
-    waypoint._state.adding = True
-    waypoint.save()
 
-    for waypoint_media in waypoint_media_items.iterator():
-        duplicate_waypoint_media(waypoint_media=waypoint_media, waypoint=waypoint)
+@transaction.atomic
+def reorder_waypoints(group: WaypointGroup, waypoint_ids: list):
+    """
+    Sets the index of every waypoint in the group to its position in
+    waypoint_ids, which must list each of the group's waypoints once.
+    """
+    waypoints = Waypoint.objects.filter(group=group)
 
+    current_ids = set(waypoints.values_list('id', flat=True))
+    if len(waypoint_ids) != len(current_ids) or set(waypoint_ids) != current_ids:
+        raise ValueError('The new order must list every waypoint in the group exactly once')
 
-@transaction.atomic
-def duplicate_waypoint_media(waypoint_media: WaypointMedia, waypoint: Waypoint):
-    waypoint_media.waypoint = waypoint
-    waypoint_media.pk = None
-    waypoint_media.id = None
-    waypoint_media._state.adding = True
-    waypoint_media.save()
+    waypoints.update(index=-F('index') - 1)
+    waypoints.update(index=Case(*[When(id=id, then=Value(index)) for index, id in enumerate(waypoint_ids)],
+                                output_field=IntegerField()))
 
+    mark_activity_dirty(activity_id=group.activity_id)
 
-def shift_waypoints_after_delete(group: WaypointGroup, deleted_index: int):
-    # Get all waypoints after the deleted index
-    greater_waypoints = Waypoint.objects.filter(group=group, index__gt=deleted_index)
 
-    # Decrease their index
-    for waypoint in greater_waypoints.iterator():
-        waypoint.index -= 1
-        waypoint.save()
+def move_waypoint(waypoint: Waypoint, index: int):
+    waypoint_ids = list(Waypoint.objects.filter(group=waypoint.group).values_list('id', flat=True))
+    waypoint_ids.remove(waypoint.id)
+    waypoint_ids.insert(index, waypoint.id)
+    reorder_waypoints(waypoint.group, waypoint_ids)
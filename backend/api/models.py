@@ -3,10 +3,16 @@
 
 import os
 import uuid
+import hashlib
+import weakref
+from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.fields.files import FieldFile, ImageFieldFile
 from django.db.models.signals import pre_save, post_delete
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.files.storage import default_storage
 
@@ -43,6 +49,123 @@ def waypointImageStorageName(instance, filename):
     return os.path.join('waypoints', str(instance.id), updated_filename)
 
 
+def blobStorageName(content, filename):
+    # blobs/{sha256[:2]}/{sha256}.ext
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    digest = digest.hexdigest()
+
+    _, ext = os.path.splitext(filename)
+    return os.path.join('blobs', digest[:2], digest + ext.lower())
+
+
+def blob_reference_count(name: str) -> int:
+    return WaypointMedia.objects.filter(media=name).count() + Activity.objects.filter(image=name).count()
+
+
+def delete_unreferenced_file(file: FieldFile):
+    """
+    Files may be shared by several rows (see BlobFileMixin), so a file is only
+    deleted once no row refers to it. Call after the referring row is deleted.
+
+    The file is not deleted here but recorded as unreferenced, and deleted by
+    sweep_unreferenced_files() once it has stayed unreferenced for a while:
+    a concurrent upload of the same content may be about to refer to it.
+    """
+    if not file or blob_reference_count(file.name) > 0:
+        return
+
+    UnreferencedFile.objects.update_or_create(name=file.name, defaults={'recorded': timezone.now()})
+
+
+def claim_files(names: list):
+    """
+    Call before reusing stored files. Waits for a sweep deleting any of them
+    to finish, and keeps later sweeps from deleting them before the rows
+    referring to them are saved.
+    """
+    UnreferencedFile.objects.filter(name__in=names).delete()
+
+
+def sweep_unreferenced_files(grace: timedelta = timedelta(hours=1)) -> int:
+    """
+    Deletes the files recorded as unreferenced more than grace ago that are
+    still unreferenced, and returns how many were deleted.
+    """
+    deleted = 0
+    names = list(UnreferencedFile.objects.filter(recorded__lt=timezone.now() - grace).values_list('name', flat=True))
+    for name in names:
+        with transaction.atomic():
+            # claim_files() waits on this lock before the file is reused
+            unreferenced = UnreferencedFile.objects.select_for_update(skip_locked=True).filter(name=name).first()
+            if unreferenced is None:
+                continue
+
+            if blob_reference_count(name) == 0 and default_storage.exists(name):
+                default_storage.delete(name)
+                deleted += 1
+            unreferenced.delete()
+
+    return deleted
+
+
+def delete_directory_if_empty(path: str):
+    # Directories may still hold files shared with a duplicated activity
+    try:
+        if default_storage.exists(path):
+            default_storage.delete(path)
+    except OSError:
+        pass
+
+
+class BlobFileMixin:
+    """
+    Stores files under the SHA-256 of their content, so identical uploads are
+    stored once and copying a row (e.g. duplicating an activity) shares the
+    file rather than copying its bytes. The upload_to of the field is kept
+    for migration history only.
+    """
+
+    def save(self, name, content, save=True):
+        name = blobStorageName(content, name)
+        claim_files([name])
+        self.store(name, content)
+
+        if save:
+            self.instance.save()
+    save.alters_data = True
+
+    def store(self, name, content):
+        """
+        Stores the content as name, which must come from blobStorageName()
+        and have been claimed with claim_files().
+        """
+        if not self.storage.exists(name):
+            name = self.storage.save(name, content, max_length=self.field.max_length)
+
+        self.name = name
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = True
+    store.alters_data = True
+
+
+class BlobFieldFile(BlobFileMixin, FieldFile):
+    pass
+
+
+class BlobImageFieldFile(BlobFileMixin, ImageFieldFile):
+    pass
+
+
+class BlobFileField(models.FileField):
+    attr_class = BlobFieldFile
+
+
+class BlobImageField(models.ImageField):
+    attr_class = BlobImageFieldFile
+
+
 def file_proxy_url(file: models.FileField):
     """
     Used for serving files from a storage account.
@@ -54,6 +177,93 @@ def file_proxy_url(file: models.FileField):
     return file.url
 
 
+class DirtyActivities:
+    """
+    Activities with unpublished changes in the current transaction, marked
+    with a single UPDATE when it commits. Children record their parent's id
+    only, so the activity is neither loaded nor saved for each child saved.
+
+    Each savepoint collects its own ids, and registers their flush with
+    on_commit() from within the savepoint. That registration is the only
+    strong reference to them, so when Django discards it on rolling back the
+    savepoint, the ids go too. The outermost flush takes the ids of every
+    savepoint that was kept, leaving the others nothing to do.
+    """
+
+    def __init__(self, using, parent=None):
+        self.using = using
+        self.activity_ids = set()
+        self.group_ids = set()
+        self.waypoint_ids = set()
+        self.flushed = False
+        self.children = weakref.WeakSet()
+        if parent is not None:
+            parent.children.add(self)
+
+    @classmethod
+    def current(cls, using):
+        connection = transaction.get_connection(using)
+        if getattr(connection, 'dirty_activities', None) is None:
+            connection.dirty_activities = weakref.WeakValueDictionary()
+
+        # Atomic blocks without a savepoint are rolled back along with the
+        # block around them, so they share its ids
+        key = tuple(sid for sid in connection.savepoint_ids if sid is not None)
+        dirty = connection.dirty_activities.get(key)
+        # Commit callbacks can also be run by hand, as tests do
+        if dirty is None or dirty.flushed:
+            parent = None
+            for i in range(len(key) - 1, -1, -1):
+                parent = connection.dirty_activities.get(key[:i])
+                if parent is not None and not parent.flushed:
+                    break
+                parent = None
+            dirty = cls(using, parent)
+            connection.dirty_activities[key] = dirty
+            transaction.on_commit(dirty.flush, using=using)
+
+        return dirty
+
+    def collect(self, activity_ids, group_ids, waypoint_ids):
+        self.flushed = True
+        activity_ids |= self.activity_ids
+        group_ids |= self.group_ids
+        waypoint_ids |= self.waypoint_ids
+        for child in list(self.children):
+            if not child.flushed:
+                child.collect(activity_ids, group_ids, waypoint_ids)
+
+    def flush(self):
+        if self.flushed:
+            return
+
+        activity_ids, group_ids, waypoint_ids = set(), set(), set()
+        self.collect(activity_ids, group_ids, waypoint_ids)
+        Activity.objects.using(self.using) \
+            .filter(Q(id__in=activity_ids) |
+                    Q(waypointgroup__id__in=group_ids) |
+                    Q(waypointgroup__waypoint__id__in=waypoint_ids)) \
+            .update(unpublished_changes=True, updated=timezone.now())
+
+
+def mark_activity_dirty(activity_id=None, group_id=None, waypoint_id=None, using='default'):
+    """
+    Marks the activity, or the activity of the group or waypoint, as having
+    unpublished changes once the current transaction commits.
+    """
+    if transaction.get_connection(using).in_atomic_block:
+        dirty = DirtyActivities.current(using)
+    else:
+        dirty = DirtyActivities(using)
+
+    for ids, id in [(dirty.activity_ids, activity_id), (dirty.group_ids, group_id), (dirty.waypoint_ids, waypoint_id)]:
+        if id is not None:
+            ids.add(id)
+
+    if not transaction.get_connection(using).in_atomic_block:
+        dirty.flush()
+
+
 class ActivityType(models.TextChoices):
     ORIENTEERING = 'Orienteering', _('Orienteering')
     GUIDED_TOUR = 'GuidedTour', _('Guided Tour')
@@ -74,6 +284,13 @@ class MediaType(models.TextChoices):
 class Locale(models.TextChoices):
     EN_US = 'en_US', _('English (United States)')
 
+
+class PublishJobStatus(models.TextChoices):
+    QUEUED = 'queued', _('Queued')
+    RUNNING = 'running', _('Running')
+    SUCCEEDED = 'succeeded', _('Succeeded')
+    FAILED = 'failed', _('Failed')
+
 # Models
 
 
@@ -97,7 +314,7 @@ class Activity(CommonModel):
     start = models.DateTimeField(blank=True, null=True)
     end = models.DateTimeField(blank=True, null=True)
     expires = models.BooleanField(default=False)
-    image = models.ImageField(blank=True, null=True, upload_to=activityImageStorageName)
+    image = BlobImageField(blank=True, null=True, db_index=True, upload_to=activityImageStorageName)
     image_alt = models.TextField(blank=True, null=True)
     last_published = models.DateTimeField(blank=True, null=True)
     unpublished_changes = models.BooleanField(default=False)
@@ -149,13 +366,20 @@ class Activity(CommonModel):
     def waypoint_groups(self, type: WaypointGroupType):
         return self.waypoint_groups_all.filter(type=type)
 
+    def first_waypoint_group(self, type: WaypointGroupType):
+        # Use the groups loaded by prefetch_activity_graph() when present
+        if 'waypointgroup_set' in getattr(self, '_prefetched_objects_cache', {}):
+            return next((group for group in self.waypointgroup_set.all() if group.type == type), None)
+
+        return self.waypoint_groups(type=type).first()
+
     @property
     def waypoints_group(self):
-        return self.waypoint_groups(type=WaypointGroupType.ORDERED).first()
+        return self.first_waypoint_group(type=WaypointGroupType.ORDERED)
 
     @property
     def pois_group(self):
-        return self.waypoint_groups(type=WaypointGroupType.UNORDERED).first()
+        return self.first_waypoint_group(type=WaypointGroupType.UNORDERED)
 
     @property
     def image_url(self):
@@ -163,8 +387,7 @@ class Activity(CommonModel):
 
     def child_entity_did_update(self):
         self.unpublished_changes = True
-        self.save()
-        pass
+        mark_activity_dirty(activity_id=self.id)
 
     def storePublishedFile(self, content):
         self.deletePublishedFile()
@@ -175,16 +398,13 @@ class Activity(CommonModel):
             default_storage.delete(self.gpx_file_path)
 
     def deleteFeaturedImageFile(self):
-        if self.image and default_storage.exists(self.image.path):
-            default_storage.delete(self.image.path)
+        delete_unreferenced_file(self.image)
 
     def deleteWaypointsMediaDirectory(self):
-        if default_storage.exists(self.waypoints_media_directory_path):
-            default_storage.delete(self.waypoints_media_directory_path)
+        delete_directory_if_empty(self.waypoints_media_directory_path)
 
     def deleteFileDirectory(self):
-        if default_storage.exists(self.file_directory_path):
-            default_storage.delete(self.file_directory_path)
+        delete_directory_if_empty(self.file_directory_path)
 
 
 class WaypointGroup(CommonModel):
@@ -203,11 +423,13 @@ class WaypointGroup(CommonModel):
         if isinstance(instance, WaypointGroup) == False:
             return
 
-        instance.activity.child_entity_did_update()
+        mark_activity_dirty(activity_id=instance.activity_id, using=using)
 
     @property
     def waypoints(self):
-        return Waypoint.objects.filter(group=self)
+        # Same as Waypoint.objects.filter(group=self), but served from the
+        # prefetch cache when the group was loaded with prefetch_activity_graph()
+        return self.waypoint_set.all()
 
     @property
     def newWaypointIndex(self):
@@ -248,8 +470,7 @@ class Waypoint(CommonModel):
         if isinstance(instance, Waypoint) == False:
             return
 
-        activity = instance.group.activity
-        activity.child_entity_did_update()
+        mark_activity_dirty(group_id=instance.group_id, using=using)
 
     @property
     def type(self):
@@ -257,20 +478,27 @@ class Waypoint(CommonModel):
 
     @property
     def media_items(self):
-        return WaypointMedia.objects.filter(waypoint=self)
+        return self.waypointmedia_set.all()
+
+    def media_items_of_type(self, type: MediaType):
+        # Filter in memory when the media was loaded with prefetch_activity_graph()
+        if 'waypointmedia_set' in getattr(self, '_prefetched_objects_cache', {}):
+            return [media for media in self.waypointmedia_set.all() if media.type == type]
+
+        return self.media_items.filter(type=type)
 
     @property
     def images(self):
-        return WaypointMedia.objects.filter(waypoint=self, type=MediaType.IMAGE)
+        return self.media_items_of_type(MediaType.IMAGE)
 
     @property
     def audio_clips(self):
-        return WaypointMedia.objects.filter(waypoint=self, type=MediaType.AUDIO)
+        return self.media_items_of_type(MediaType.AUDIO)
 
 
 class WaypointMedia(CommonModel):
     waypoint = models.ForeignKey(Waypoint, on_delete=models.CASCADE)
-    media = models.FileField(upload_to=waypointMediaStorageName)
+    media = BlobFileField(db_index=True, upload_to=waypointMediaStorageName)
     type = models.CharField(max_length=20, choices=MediaType.choices)
     mime_type = models.TextField()
     description = models.TextField(blank=True, null=True)  # For images, this is the alt text
@@ -284,8 +512,7 @@ class WaypointMedia(CommonModel):
         if isinstance(instance, WaypointMedia) == False:
             return
 
-        activity = instance.waypoint.group.activity
-        activity.child_entity_did_update()
+        mark_activity_dirty(waypoint_id=instance.waypoint_id, using=using)
 
     @receiver(post_delete)
     def delete_file(sender, instance, **kwargs):
@@ -299,8 +526,55 @@ class WaypointMedia(CommonModel):
         return file_proxy_url(self.media)
 
     def delete_media_file(self):
-        if self.media and default_storage.exists(self.media.path):
-            default_storage.delete(self.media.path)
+        delete_unreferenced_file(self.media)
+
+
+class PublishJob(CommonModel):
+    """
+    The pending or last publish of an activity, run by the publish_worker
+    management command. There is at most one job per activity: requesting a
+    publish while one is queued joins it, and requesting one while it runs
+    makes the worker run it again afterwards, so the latest request wins.
+    """
+    activity = models.OneToOneField(Activity, on_delete=models.CASCADE, related_name='publish_job')
+    status = models.CharField(max_length=20, choices=PublishJobStatus.choices, default=PublishJobStatus.QUEUED)
+    generation = models.IntegerField(default=0)  # Increased by every publish request
+    claimed_generation = models.IntegerField(blank=True, null=True)  # The generation being run by the worker
+    requested = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)  # Updated by the worker while the job runs
+    finished = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['requested']
+
+    def __str__(self):
+        return '{0} ({1})'.format(self.activity.name, self.status)
+
+
+class UnreferencedFile(CommonModel):
+    """
+    A stored file that no row referred to when it was recorded, deleted by
+    sweep_unreferenced_files() unless it is referred to again.
+    """
+    name = models.TextField(unique=True)
+    recorded = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+
+activity_graph_lookup = 'waypointgroup_set__waypoint_set__waypointmedia_set'
+
+
+def prefetch_activity_graph(queryset):
+    """
+    Loads the waypoint groups, waypoints and media of every activity in the
+    queryset up front, so that serializing an activity or exporting it as GPX
+    takes the same number of queries however many waypoints it has.
+    """
+    return queryset.prefetch_related(activity_graph_lookup)
 
 
 class UserPermissions(models.Model):
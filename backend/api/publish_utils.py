@@ -0,0 +1,127 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.core.files.base import File
+from django.db import connections, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.utils import timezone
+
+from .models import Activity, PublishJob, PublishJobStatus
+from .gpx_utils import activity_to_gpx_chunks
+
+logger = logging.getLogger(__name__)
+
+# GPX documents larger than this are spooled to a temporary file on disk
+# while being published
+gpx_spool_size = 1024 * 1024
+
+# Seconds between updates of a running job's heartbeat. Jobs are requeued
+# when their heartbeat is older than the worker's --stale_after.
+heartbeat_interval = 30
+
+
+def publish_activity(activity: Activity, claimed: datetime):
+    # Storage backends need a seekable file, so spool the document rather
+    # than building it in memory
+    with tempfile.SpooledTemporaryFile(max_size=gpx_spool_size) as spool:
+        for chunk in activity_to_gpx_chunks(activity):
+            spool.write(chunk.encode('utf-8'))
+        spool.seek(0)
+        activity.storePublishedFile(File(spool))
+
+    # Changes saved after the job was claimed may have missed the published
+    # document, so they are left unpublished
+    Activity.objects.filter(pk=activity.pk).update(
+        last_published=timezone.now(),
+        unpublished_changes=Case(When(updated__lte=claimed, then=Value(False)), default=F('unpublished_changes')))
+
+
+def request_publish(activity: Activity) -> PublishJob:
+    with transaction.atomic():
+        job, created = PublishJob.objects.get_or_create(activity=activity)
+        if not created:
+            # A queued job already covers this request. A running job sees the
+            # new generation when it finishes and is queued again.
+            PublishJob.objects.filter(pk=job.pk).update(generation=F('generation') + 1)
+            PublishJob.objects.filter(pk=job.pk, status__in=[PublishJobStatus.SUCCEEDED, PublishJobStatus.FAILED]) \
+                .update(status=PublishJobStatus.QUEUED, requested=timezone.now(), error=None)
+            job.refresh_from_db()
+
+    return job
+
+
+def requeue_stale_jobs(stale_after: timedelta):
+    # Jobs left running by a worker that exited, which stopped updating their
+    # heartbeat. A job that is merely slow keeps its heartbeat fresh.
+    stale = timezone.now() - stale_after
+    return PublishJob.objects.filter(status=PublishJobStatus.RUNNING) \
+        .filter(Q(heartbeat__lt=stale) | Q(heartbeat__isnull=True, started__lt=stale)) \
+        .update(status=PublishJobStatus.QUEUED)
+
+
+@contextmanager
+def heartbeat(job: PublishJob):
+    # Beats from a thread, as publishing blocks the worker's own thread
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(heartbeat_interval):
+                PublishJob.objects.filter(pk=job.pk, status=PublishJobStatus.RUNNING) \
+                    .update(heartbeat=timezone.now())
+        finally:
+            # Connections belong to the thread that opened them
+            connections.close_all()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def claim_next_job():
+    for job in PublishJob.objects.filter(status=PublishJobStatus.QUEUED)[:10]:
+        # Only one worker can move a job out of the queued state
+        claimed = PublishJob.objects.filter(pk=job.pk, status=PublishJobStatus.QUEUED, generation=job.generation) \
+            .update(status=PublishJobStatus.RUNNING, claimed_generation=job.generation,
+                    started=timezone.now(), heartbeat=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+    return None
+
+
+def finish_job(job: PublishJob, status: PublishJobStatus, error: str = None):
+    finished = PublishJob.objects.filter(pk=job.pk, generation=job.claimed_generation) \
+        .update(status=status, finished=timezone.now(), error=error)
+    if not finished:
+        # Publish was requested again while this job ran; run it again so the
+        # latest request wins
+        PublishJob.objects.filter(pk=job.pk).update(status=PublishJobStatus.QUEUED)
+
+
+def run_next_job() -> bool:
+    job = claim_next_job()
+    if job is None:
+        return False
+
+    try:
+        with heartbeat(job):
+            publish_activity(job.activity, job.started)
+    except Exception as e:
+        logger.exception('Publishing activity {0} failed'.format(job.activity_id))
+        finish_job(job, PublishJobStatus.FAILED, str(e))
+    else:
+        finish_job(job, PublishJobStatus.SUCCEEDED)
+
+    return True
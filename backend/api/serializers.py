@@ -3,7 +3,7 @@
 
 from rest_framework import serializers
 
-from .models import Activity, WaypointGroup, Waypoint, WaypointMedia
+from .models import Activity, WaypointGroup, Waypoint, WaypointMedia, PublishJob
 
 
 class WaypointMediaSerializer(serializers.ModelSerializer):
@@ -59,3 +59,9 @@ class ActivityDetailSerializer(serializers.ModelSerializer):
             'image': {'write_only': True},
             'image_url': {'read_only': True},
         }
+
+
+class PublishJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PublishJob
+        fields = ['activity', 'status', 'requested', 'started', 'finished', 'error']
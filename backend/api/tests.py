@@ -0,0 +1,664 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import tempfile
+from datetime import timedelta
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+import gpxpy
+import gpxpy.gpx
+
+from users.models import User
+from .models import Activity, ActivityType, WaypointGroup, Waypoint, WaypointMedia, MediaType, WaypointGroupType, PublishJob, PublishJobStatus, \
+    sweep_unreferenced_files
+from .gpx_utils import activity_to_gpx, waypoint_to_gpx, GPXVersion, WaypointType, GPX_NSMAP, GPXSC_NS, GPXSC_NS_FULL, mod_etree
+from .fetch_utils import fetch_all
+from .publish_utils import request_publish, claim_next_job, finish_job, run_next_job, requeue_stale_jobs, publish_activity
+from .model_utils import duplicate_activity, reorder_waypoints
+
+
+def document_gpx(activity):
+    """
+    The activity's GPX built as one gpxpy document and serialized with
+    to_xml(), which the streamed export must match.
+    """
+    version = GPXVersion.v1 if activity.type == ActivityType.ORIENTEERING else GPXVersion.v2
+
+    gpx = gpxpy.gpx.GPX()
+    gpx.nsmap = GPX_NSMAP
+    gpx.creator = 'Microsoft Soundscape Authoring Tool'
+    gpx.name = activity.name
+    gpx.description = activity.description
+    gpx.author_name = activity.author_name
+    gpx.time = activity.updated
+
+    gpxsc_meta = mod_etree.Element(GPXSC_NS + 'meta')
+    gpxsc_meta.attrib['expires'] = 'true' if activity.expires else 'false'
+    mod_etree.SubElement(gpxsc_meta, GPXSC_NS + 'id').text = str(activity.id)
+    mod_etree.SubElement(gpxsc_meta, GPXSC_NS + 'locale').text = activity.locale
+    mod_etree.SubElement(gpxsc_meta, GPXSC_NS + 'behavior').text = activity.type
+    mod_etree.SubElement(gpxsc_meta, GPXSC_NS + 'version').text = str(version.value)
+    gpx.metadata_extensions.append(gpxsc_meta)
+
+    waypoints = Waypoint.objects.filter(group=activity.waypoints_group)
+    pois = Waypoint.objects.filter(group=activity.pois_group)
+
+    if version == GPXVersion.v1:
+        gpx.waypoints.extend(waypoint_to_gpx(waypoint) for waypoint in waypoints)
+    else:
+        route = gpxpy.gpx.GPXRoute()
+        route.points.extend(waypoint_to_gpx(waypoint, type=WaypointType.routePoint) for waypoint in waypoints)
+        gpx.routes.append(route)
+        gpx.waypoints.extend(waypoint_to_gpx(poi) for poi in pois)
+
+    return gpx.to_xml()
+
+
+def create_activity(author_id, waypoint_count, poi_count=0):
+    activity = Activity.objects.create(author_id=author_id, author_name='Author',
+                                       name='Activity', description='Description')
+    waypoints_group = WaypointGroup.objects.create(activity=activity, name='Default', type=WaypointGroupType.ORDERED)
+    pois_group = WaypointGroup.objects.create(activity=activity, name='Points of Interest', type=WaypointGroupType.UNORDERED)
+
+    for index in range(waypoint_count):
+        waypoint = Waypoint.objects.create(group=waypoints_group, index=index, name='Waypoint {}'.format(index),
+                                           latitude='47.6', longitude='-122.3')
+        WaypointMedia.objects.create(waypoint=waypoint, media='image.jpg', type=MediaType.IMAGE,
+                                     mime_type='image/jpeg', description='Image', index=0)
+        WaypointMedia.objects.create(waypoint=waypoint, media='audio.mp3', type=MediaType.AUDIO,
+                                     mime_type='audio/mpeg', description='Audio', index=0)
+
+    for index in range(poi_count):
+        Waypoint.objects.create(group=pois_group, name='POI {}'.format(index),
+                                latitude='47.6', longitude='-122.3')
+
+    return activity
+
+
+class ActivityDetailQueryTests(TestCase):
+    # Activity, waypoint groups, waypoints and waypoint media
+    expected_queries = 4
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def test_detail_query_count_is_constant(self):
+        for waypoint_count in [1, 25]:
+            activity = create_activity(self.user.id, waypoint_count, poi_count=waypoint_count)
+
+            with self.assertNumQueries(self.expected_queries):
+                response = self.client.get('/api/v1/activities/{}/'.format(activity.id))
+
+            self.assertEqual(response.status_code, 200)
+            waypoints = response.data['waypoints_group']['waypoints']
+            self.assertEqual(len(waypoints), waypoint_count)
+            self.assertEqual(len(response.data['pois_group']['waypoints']), waypoint_count)
+            self.assertEqual([waypoint['index'] for waypoint in waypoints], list(range(waypoint_count)))
+            self.assertEqual(len(waypoints[0]['images']), 1)
+            self.assertEqual(len(waypoints[0]['audio_clips']), 1)
+
+    def test_export_query_count_is_constant(self):
+        for waypoint_count in [1, 25]:
+            activity = create_activity(self.user.id, waypoint_count, poi_count=waypoint_count)
+
+            with self.assertNumQueries(self.expected_queries):
+                response = self.client.get('/api/v1/activities/{}/export_gpx/'.format(activity.id))
+                content = b''.join(response.streaming_content).decode('utf-8')
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(content.count('image/jpeg'), waypoint_count)
+
+    def test_update_query_count_is_constant(self):
+        # Fetching and saving the activity, then its graph for the response
+        expected_queries = 2 + self.expected_queries
+        for waypoint_count in [1, 25]:
+            activity = create_activity(self.user.id, waypoint_count, poi_count=waypoint_count)
+
+            with self.assertNumQueries(expected_queries):
+                response = self.client.patch('/api/v1/activities/{}/'.format(activity.id), {'name': 'Renamed'})
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['name'], 'Renamed')
+            self.assertEqual(len(response.data['waypoints_group']['waypoints']), waypoint_count)
+            self.assertEqual(len(response.data['pois_group']['waypoints']), waypoint_count)
+
+    def test_export_is_limited_to_author(self):
+        activity = create_activity('someone else', 1)
+
+        response = self.client.get('/api/v1/activities/{}/export_gpx/'.format(activity.id))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class ActivityGPXQueryTests(TestCase):
+    def test_gpx_query_count_is_constant(self):
+        for type in [ActivityType.ORIENTEERING, ActivityType.GUIDED_TOUR]:
+            for waypoint_count in [1, 25]:
+                activity = create_activity('author', waypoint_count, poi_count=waypoint_count)
+                activity.type = type
+                activity.save()
+                activity = Activity.objects.get(id=activity.id)
+
+                # Waypoint groups, waypoints and waypoint media
+                with self.assertNumQueries(3):
+                    content = activity_to_gpx(activity)
+
+                self.assertEqual(content.count('image/jpeg'), waypoint_count)
+                self.assertEqual(content.count('audio/mpeg'), waypoint_count)
+
+
+class ActivityGPXViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        self.activity = create_activity(self.user.id, 3, poi_count=2)
+
+    def test_export_gpx_streams_document(self):
+        for type in [ActivityType.ORIENTEERING, ActivityType.GUIDED_TOUR]:
+            Activity.objects.filter(id=self.activity.id).update(type=type)
+
+            response = self.client.get('/api/v1/activities/{}/export_gpx/'.format(self.activity.id))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.streaming)
+            content = b''.join(response.streaming_content).decode('utf-8')
+            activity = Activity.objects.get(id=self.activity.id)
+            self.assertEqual(content, document_gpx(activity))
+
+            gpx = gpxpy.parse(content)
+            meta = gpx.metadata_extensions[0]
+            self.assertEqual(meta.find(GPXSC_NS_FULL + 'id').text, str(activity.id))
+            if type == ActivityType.ORIENTEERING:
+                self.assertEqual([w.name for w in gpx.waypoints], ['Waypoint 0', 'Waypoint 1', 'Waypoint 2'])
+                self.assertEqual(len(gpx.routes), 0)
+                points = gpx.waypoints
+            else:
+                self.assertEqual([w.name for w in gpx.waypoints], ['POI 0', 'POI 1'])
+                self.assertEqual([p.name for p in gpx.routes[0].points], ['Waypoint 0', 'Waypoint 1', 'Waypoint 2'])
+                points = gpx.routes[0].points
+            for point in points:
+                links = point.extensions[0]
+                self.assertEqual(links.tag, GPXSC_NS_FULL + 'links')
+                self.assertEqual([link.find('type').text for link in links], ['image/jpeg', 'audio/mpeg'])
+
+    def test_publish_stores_document(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            response = self.client.post('/api/v1/activities/{}/publish/'.format(self.activity.id))
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(response.data['status'], PublishJobStatus.QUEUED)
+
+            call_command('publish_worker', once=True, stdout=None)
+
+            response = self.client.get('/api/v1/activities/{}/publish_status/'.format(self.activity.id))
+            self.assertEqual(response.data['status'], PublishJobStatus.SUCCEEDED)
+
+            activity = Activity.objects.get(id=self.activity.id)
+            self.assertIsNotNone(activity.last_published)
+            self.assertFalse(activity.unpublished_changes)
+            with default_storage.open(activity.gpx_file_path) as f:
+                content = f.read().decode('utf-8')
+            self.assertEqual(content, activity_to_gpx(activity))
+
+
+class PublishJobTests(TestCase):
+    def setUp(self):
+        self.activity = create_activity('author', 1)
+
+    def test_repeated_requests_share_one_job(self):
+        first = request_publish(self.activity)
+        second = request_publish(self.activity)
+
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(second.status, PublishJobStatus.QUEUED)
+
+        self.assertIsNotNone(claim_next_job())
+        self.assertIsNone(claim_next_job())
+
+    def test_request_while_running_runs_again(self):
+        request_publish(self.activity)
+        job = claim_next_job()
+
+        # Requested again while the first publish is running
+        request_publish(self.activity)
+        finish_job(job, PublishJobStatus.SUCCEEDED)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishJobStatus.QUEUED)
+
+        job = claim_next_job()
+        finish_job(job, PublishJobStatus.SUCCEEDED)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishJobStatus.SUCCEEDED)
+
+    def test_only_jobs_without_heartbeat_are_requeued(self):
+        request_publish(self.activity)
+        job = claim_next_job()
+        started = timezone.now() - timedelta(hours=1)
+
+        # Running for an hour, but still beating
+        PublishJob.objects.filter(pk=job.pk).update(started=started, heartbeat=timezone.now())
+        self.assertEqual(requeue_stale_jobs(timedelta(minutes=10)), 0)
+
+        PublishJob.objects.filter(pk=job.pk).update(heartbeat=started)
+        self.assertEqual(requeue_stale_jobs(timedelta(minutes=10)), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishJobStatus.QUEUED)
+
+    def test_changes_during_publish_stay_unpublished(self):
+        request_publish(self.activity)
+        job = claim_next_job()
+
+        # Edited after the worker claimed the job
+        activity = Activity.objects.get(id=self.activity.id)
+        activity.name = 'Renamed'
+        activity.save()
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            publish_activity(job.activity, job.started)
+
+        activity.refresh_from_db()
+        self.assertIsNotNone(activity.last_published)
+        self.assertTrue(activity.unpublished_changes)
+
+    def test_publish_status_is_limited_to_author(self):
+        request_publish(self.activity)
+        client = APIClient()
+        client.force_authenticate(user=User.objects.create_user(username='someone else', password='password'))
+
+        response = client.get('/api/v1/activities/{}/publish_status/'.format(self.activity.id))
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_failed_publish_is_recorded(self):
+        job = request_publish(self.activity)
+
+        with mock.patch('api.publish_utils.publish_activity', side_effect=OSError('storage unavailable')), \
+                self.assertLogs('api.publish_utils', level='ERROR'):
+            self.assertTrue(run_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, PublishJobStatus.FAILED)
+        self.assertEqual(job.error, 'storage unavailable')
+        self.assertFalse(run_next_job())
+
+        # Publishing again queues the failed job
+        self.assertEqual(request_publish(self.activity).status, PublishJobStatus.QUEUED)
+
+
+class DuplicateActivityTests(TestCase):
+    def duplicate(self, waypoint_count):
+        activity = create_activity('author', waypoint_count, poi_count=waypoint_count)
+        with CaptureQueriesContext(connection) as queries:
+            duplicated = duplicate_activity(Activity.objects.get(id=activity.id))
+        return activity, duplicated, len(queries)
+
+    def test_duplicate_copies_activity_graph(self):
+        activity, duplicated, _ = self.duplicate(3)
+
+        self.assertNotEqual(activity.id, duplicated.id)
+        self.assertEqual(duplicated.name, 'Activity copy')
+        self.assertTrue(Activity.objects.get(id=duplicated.id).unpublished_changes)
+        for type in [WaypointGroupType.ORDERED, WaypointGroupType.UNORDERED]:
+            original = activity.first_waypoint_group(type)
+            copy = duplicated.first_waypoint_group(type)
+            self.assertNotEqual(original.id, copy.id)
+            self.assertEqual([(w.index, w.name) for w in original.waypoints],
+                             [(w.index, w.name) for w in copy.waypoints])
+        self.assertEqual(WaypointMedia.objects.filter(waypoint__group__activity=duplicated).count(), 6)
+        self.assertEqual(WaypointMedia.objects.filter(waypoint__group__activity=activity).count(), 6)
+
+    def test_duplicate_query_count_is_constant(self):
+        _, _, small = self.duplicate(1)
+        _, _, large = self.duplicate(25)
+        self.assertEqual(small, large)
+
+
+class BlobMediaTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        self.settings.enable()
+        self.activity = create_activity('author', 1)
+        self.waypoint = Waypoint.objects.filter(group__activity=self.activity).first()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.media_root.cleanup()
+
+    def sweep(self):
+        return sweep_unreferenced_files(grace=timedelta(0))
+
+    def add_media(self, content):
+        waypoint_media = WaypointMedia(waypoint=self.waypoint, type=MediaType.AUDIO, mime_type='audio/mpeg')
+        waypoint_media.media.save('clip.MP3', ContentFile(content))
+        return waypoint_media
+
+    def test_identical_content_is_stored_once(self):
+        first = self.add_media(b'audio')
+        second = self.add_media(b'audio')
+        other = self.add_media(b'other audio')
+
+        self.assertEqual(first.media.name, second.media.name)
+        self.assertNotEqual(first.media.name, other.media.name)
+        self.assertTrue(first.media.name.startswith('blobs/'))
+        self.assertTrue(first.media.name.endswith('.mp3'))
+
+        first.delete()
+        self.sweep()
+        self.assertTrue(default_storage.exists(second.media.name))
+        second.delete()
+        self.assertTrue(default_storage.exists(second.media.name))
+        self.sweep()
+        self.assertFalse(default_storage.exists(second.media.name))
+
+    def test_reused_file_is_not_swept(self):
+        waypoint_media = self.add_media(b'audio')
+        waypoint_media.delete()
+
+        # Uploaded again before the sweep
+        again = self.add_media(b'audio')
+        self.sweep()
+        self.assertTrue(default_storage.exists(again.media.name))
+
+    def test_recently_unreferenced_file_is_kept(self):
+        waypoint_media = self.add_media(b'audio')
+        waypoint_media.delete()
+
+        self.assertEqual(sweep_unreferenced_files(), 0)
+        self.assertTrue(default_storage.exists(waypoint_media.media.name))
+
+    def test_duplicated_activity_shares_files(self):
+        waypoint_media = self.add_media(b'audio')
+        self.activity.image.save('featured.png', ContentFile(b'image'))
+
+        duplicated = duplicate_activity(Activity.objects.get(id=self.activity.id))
+        self.assertEqual(duplicated.image.name, self.activity.image.name)
+
+        Activity.objects.get(id=self.activity.id).delete()
+        self.assertTrue(default_storage.exists(waypoint_media.media.name))
+        self.assertTrue(default_storage.exists(duplicated.image.name))
+
+        Activity.objects.get(id=duplicated.id).delete()
+        self.sweep()
+        self.assertFalse(default_storage.exists(waypoint_media.media.name))
+        self.assertFalse(default_storage.exists(duplicated.image.name))
+
+
+class WaypointOrderTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='author', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def create_group(self, waypoint_count):
+        activity = create_activity(self.user.id, waypoint_count)
+        group = activity.first_waypoint_group(WaypointGroupType.ORDERED)
+        return group, list(Waypoint.objects.filter(group=group).values_list('id', flat=True))
+
+    def indexes(self, group):
+        return list(Waypoint.objects.filter(group=group).values_list('id', 'index'))
+
+    def test_reorder_moves_waypoint_in_one_request(self):
+        group, ids = self.create_group(80)
+        new_order = [ids[79]] + ids[:79]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/waypoint_groups/{}/reorder/'.format(group.id),
+                                        {'waypoints': [str(id) for id in new_order]}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.indexes(group), [(id, index) for index, id in enumerate(new_order)])
+        self.assertEqual([waypoint['id'] for waypoint in response.data['waypoints']], [str(id) for id in new_order])
+        self.assertTrue(Activity.objects.get(id=group.activity_id).unpublished_changes)
+
+    def test_reorder_query_count_is_constant(self):
+        counts = []
+        for waypoint_count in [2, 40]:
+            group, ids = self.create_group(waypoint_count)
+            with CaptureQueriesContext(connection) as queries:
+                reorder_waypoints(group, list(reversed(ids)))
+            counts.append(len(queries))
+            self.assertEqual(self.indexes(group), [(id, index) for index, id in enumerate(reversed(ids))])
+        self.assertEqual(counts[0], counts[1])
+
+    def test_reorder_rejects_incomplete_order(self):
+        group, ids = self.create_group(3)
+
+        for waypoints in [ids[:2], ids + ids[:1], ids[:2] + ids[:1], ['not-an-id']]:
+            response = self.client.post('/api/v1/waypoint_groups/{}/reorder/'.format(group.id),
+                                        {'waypoints': [str(id) for id in waypoints]}, format='json')
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.indexes(group), [(id, index) for index, id in enumerate(ids)])
+
+    def test_update_moves_waypoint_to_any_index(self):
+        group, ids = self.create_group(5)
+
+        response = self.client.patch('/api/v1/waypoints/{}/'.format(ids[4]), {'index': 1}, format='multipart')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([id for id, _ in self.indexes(group)], [ids[0], ids[4], ids[1], ids[2], ids[3]])
+
+    def test_update_rejects_index_out_of_range(self):
+        group, ids = self.create_group(5)
+
+        for index in [-1, 5, 6]:
+            response = self.client.patch('/api/v1/waypoints/{}/'.format(ids[2]), {'index': index}, format='multipart')
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.indexes(group), [(id, index) for index, id in enumerate(ids)])
+
+    def test_delete_compacts_indexes(self):
+        group, ids = self.create_group(5)
+
+        response = self.client.delete('/api/v1/waypoints/{}/'.format(ids[1]))
+
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.indexes(group), [(id, index) for index, id in enumerate(ids[:1] + ids[2:])])
+
+
+class DirtyActivityTests(TestCase):
+    def setUp(self):
+        # Run the commit callbacks of the setup, so that the tests start with
+        # no pending changes
+        with self.captureOnCommitCallbacks(execute=True):
+            self.activity = create_activity('author', 3)
+        Activity.objects.filter(id=self.activity.id).update(unpublished_changes=False)
+
+    def activity_updates(self, queries):
+        return [query for query in queries if query['sql'].startswith('UPDATE "api_activity"')]
+
+    def test_child_saves_mark_activity_once_on_commit(self):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                for waypoint in Waypoint.objects.filter(group__activity=self.activity):
+                    waypoint.name = 'Renamed'
+                    waypoint.save()
+                for waypoint_media in WaypointMedia.objects.filter(waypoint__group__activity=self.activity):
+                    waypoint_media.description = 'Renamed'
+                    waypoint_media.save()
+
+                self.assertFalse(Activity.objects.get(id=self.activity.id).unpublished_changes)
+
+        self.assertEqual(len(self.activity_updates(queries)), 1)
+        self.assertTrue(Activity.objects.get(id=self.activity.id).unpublished_changes)
+
+    def test_rolled_back_changes_do_not_mark_activity(self):
+        waypoint = Waypoint.objects.filter(group__activity=self.activity).first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    waypoint.save()
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        self.assertFalse(Activity.objects.get(id=self.activity.id).unpublished_changes)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            waypoint.save()
+
+        self.assertTrue(Activity.objects.get(id=self.activity.id).unpublished_changes)
+
+
+    def test_rolled_back_savepoint_does_not_mark_activity(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = create_activity('author', 1)
+        Activity.objects.filter(id=other.id).update(unpublished_changes=False)
+        waypoint = Waypoint.objects.filter(group__activity=self.activity).first()
+        other_waypoint = Waypoint.objects.filter(group__activity=other).first()
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                other_waypoint.save()
+                try:
+                    with transaction.atomic():
+                        waypoint.save()
+                        raise ValueError()
+                except ValueError:
+                    pass
+
+        self.assertEqual(len(self.activity_updates(queries)), 1)
+        self.assertFalse(Activity.objects.get(id=self.activity.id).unpublished_changes)
+        self.assertTrue(Activity.objects.get(id=other.id).unpublished_changes)
+
+    def test_kept_savepoint_marks_activity_with_outer_block(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            other = create_activity('author', 1)
+        Activity.objects.filter(id=other.id).update(unpublished_changes=False)
+        waypoint = Waypoint.objects.filter(group__activity=self.activity).first()
+        other_waypoint = Waypoint.objects.filter(group__activity=other).first()
+
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                other_waypoint.save()
+                with transaction.atomic():
+                    waypoint.save()
+
+        self.assertEqual(len(self.activity_updates(queries)), 1)
+        self.assertTrue(Activity.objects.get(id=self.activity.id).unpublished_changes)
+        self.assertTrue(Activity.objects.get(id=other.id).unpublished_changes)
+
+
+class QuietRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class GPXImportTests(TestCase):
+    """
+    Imports exported activities, fetching their media from a local HTTP
+    server that serves the media directory.
+    """
+
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        media_root = os.path.join(self.root.name, 'files')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietRequestHandler, directory=self.root.name))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.settings = override_settings(MEDIA_ROOT=media_root, MEDIA_URL='files/',
+                                          FILE_UPLOAD_BASE_URL='http://127.0.0.1:{}/'.format(self.server.server_port))
+        self.settings.enable()
+
+        self.user = User.objects.create_user(username='author', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.settings.disable()
+        self.root.cleanup()
+
+    def create_exported_activity(self, waypoint_count, poi_count=0):
+        # Guided tours are exported as GPX v2, which includes the POIs
+        activity = create_activity(self.user.id, waypoint_count, poi_count=poi_count)
+        activity.type = ActivityType.GUIDED_TOUR
+        activity.save()
+        for index, waypoint_media in enumerate(WaypointMedia.objects.filter(waypoint__group__activity=activity)):
+            waypoint_media.media.save('media.bin', ContentFile('media {}'.format(index).encode()))
+        activity.image.save('featured.png', ContentFile(b'image'))
+
+        return activity, activity_to_gpx(Activity.objects.get(id=activity.id))
+
+    def import_gpx(self, content):
+        gpx = SimpleUploadedFile('activity.gpx', content.encode('utf-8'), content_type='application/gpx+xml')
+        return self.client.post('/api/v1/activities/import_gpx/', {'gpx': gpx}, format='multipart')
+
+    def media_of(self, activity_id):
+        return sorted((m.waypoint.name, m.type, m.description, m.media.name)
+                      for m in WaypointMedia.objects.filter(waypoint__group__activity_id=activity_id))
+
+    def test_import_fetches_media(self):
+        activity, content = self.create_exported_activity(3, poi_count=2)
+
+        response = self.import_gpx(content)
+
+        self.assertEqual(response.status_code, 200)
+        imported = Activity.objects.get(id=response.data['id'])
+        self.assertNotEqual(imported.id, activity.id)
+        self.assertEqual(imported.image.name, Activity.objects.get(id=activity.id).image.name)
+        self.assertEqual(self.media_of(imported.id), self.media_of(activity.id))
+        self.assertEqual([w.name for w in imported.waypoints_group.waypoints], [w.name for w in activity.waypoints_group.waypoints])
+        self.assertEqual(imported.pois_group.waypoints.count(), 2)
+
+    def test_media_is_fetched_outside_transaction(self):
+        _, content = self.create_exported_activity(2)
+        savepoints = len(connection.savepoint_ids)
+
+        def fetch_outside_transaction(urls):
+            self.assertEqual(len(connection.savepoint_ids), savepoints)
+            return fetch_all(urls)
+
+        with mock.patch('api.gpx_utils.fetch_all', side_effect=fetch_outside_transaction) as fetch:
+            response = self.import_gpx(content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_unavailable_media_is_skipped(self):
+        activity, _ = self.create_exported_activity(3)
+        media = list(WaypointMedia.objects.filter(waypoint__group__activity=activity))
+        os.remove(os.path.join(settings.MEDIA_ROOT, media[0].media.name))
+        media[1].media.save('large.bin', ContentFile(b'x' * 100))
+        content = activity_to_gpx(Activity.objects.get(id=activity.id))
+
+        with mock.patch('api.fetch_utils.fetch_max_size', 50), self.assertLogs('api.fetch_utils', level='WARNING'):
+            response = self.import_gpx(content)
+
+        self.assertEqual(response.status_code, 200)
+        imported = set(WaypointMedia.objects.filter(waypoint__group__activity_id=response.data['id'])
+                       .values_list('media', flat=True))
+        self.assertEqual(imported, set(m.media.name for m in media[2:]))
+
+    def test_import_query_count_is_constant(self):
+        counts = []
+        for poi_count in [1, 30]:
+            _, content = self.create_exported_activity(poi_count, poi_count=poi_count)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.import_gpx(content)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Waypoint.objects.filter(group__activity_id=response.data['id']).count(), 2 * poi_count)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
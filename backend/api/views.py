@@ -2,27 +2,27 @@
 # Licensed under the MIT License.
 
 import os
+import uuid
 import logging
 
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
 from django.db import transaction
-from django.utils import timezone
 
 from rest_framework.viewsets import ModelViewSet
-from rest_framework.exceptions import APIException
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework import status
 from rest_framework.serializers import ValidationError
 
-from .models import Waypoint, WaypointGroup, WaypointMedia, MediaType, Activity, WaypointGroupType
-from .serializers import ActivityListSerializer, ActivityDetailSerializer, WaypointGroupSerializer, WaypointSerializer, WaypointMediaSerializer
-from .model_utils import duplicate_activity, shift_waypoints_after_delete
-from .gpx_utils import activity_to_gpx, gpx_to_activity
+from .models import Waypoint, WaypointGroup, WaypointMedia, MediaType, Activity, WaypointGroupType, PublishJob, prefetch_activity_graph
+from .serializers import ActivityListSerializer, ActivityDetailSerializer, WaypointGroupSerializer, WaypointSerializer, WaypointMediaSerializer, PublishJobSerializer
+from .model_utils import duplicate_activity, shift_waypoints_after_delete, reorder_waypoints, move_waypoint
+from .gpx_utils import activity_to_gpx_chunks, gpx_to_activity
+from .publish_utils import request_publish
 
-def gpx_response(content, filename):
-    response = HttpResponse(content, content_type='application/gpx+xml')
+def gpx_response(chunks, filename):
+    response = StreamingHttpResponse(chunks, content_type='application/gpx+xml')
     response['Content-Disposition'] = 'attachment; filename="{0}.gpx"'.format(filename)
     return response
 
@@ -35,6 +35,9 @@ class ActivityViewSet(ModelViewSet):
         if user_id == None:
             raise ValidationError('Missing user id')
         queryset = Activity.objects.filter(author_id=user_id)
+        # Only the actions that render the whole activity need its graph
+        if self.action in ('retrieve', 'export_gpx'):
+            queryset = prefetch_activity_graph(queryset)
         return queryset
 
     def get_serializer_class(self):
@@ -56,38 +59,52 @@ class ActivityViewSet(ModelViewSet):
             WaypointGroup(activity=instance, name='Default', type=WaypointGroupType.ORDERED).save()
             WaypointGroup(activity=instance, name='Points of Interest', type=WaypointGroupType.UNORDERED).save()
 
+    def update(self, request, *args, **kwargs):
+        partial = kwargs.pop('partial', False)
+        instance = self.get_object()
+        serializer = self.get_serializer(instance, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        self.perform_update(serializer)
+
+        # Render the saved activity with its whole graph fetched up front
+        queryset = prefetch_activity_graph(Activity.objects).get(id=instance.id)
+        serializer = self.get_serializer(queryset, many=False)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['POST'], name='Duplicate')
     def duplicate(self, request, pk=None):
         activity = Activity.objects.get(id=pk)
         duplicated = duplicate_activity(activity)
 
-        queryset = Activity.objects.get(id=duplicated.id)
+        queryset = prefetch_activity_graph(Activity.objects).get(id=duplicated.id)
         serializer = self.get_serializer(queryset, many=False)
         return Response(serializer.data)
 
     @action(detail=True, methods=['POST'], name='Publish')
     def publish(self, request, pk=None):
-        activity: Activity = Activity.objects.get(id=pk)
-
-        content = activity_to_gpx(activity)
-        content_bytes = bytes(content, 'utf-8')
-        content_file = ContentFile(content_bytes)
+        # Publishing is done by the publish_worker management command; poll
+        # publish_status to find out when it is done
+        activity: Activity = self.get_object()
+        job = request_publish(activity)
 
-        activity.storePublishedFile(content_file)
+        serializer = PublishJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
 
-        activity.last_published = timezone.now()
-        activity.unpublished_changes = False
-        activity.save(update_fields=['last_published', 'unpublished_changes'])
+    @action(detail=True, methods=['GET'], name='Publish Status')
+    def publish_status(self, request, pk=None):
+        activity: Activity = self.get_object()
+        try:
+            job = PublishJob.objects.get(activity=activity)
+        except PublishJob.DoesNotExist:
+            return Response(status=status.HTTP_404_NOT_FOUND)
 
-        queryset = Activity.objects.get(id=activity.id)
-        serializer = self.get_serializer(queryset, many=False)
+        serializer = PublishJobSerializer(job)
         return Response(serializer.data)
 
     @action(detail=True, methods=['GET'], name='Export GPX')
     def export_gpx(self, request, pk=None):
-        activity = Activity.objects.get(id=pk)
-        content = activity_to_gpx(activity)
-        return gpx_response(content, activity.name)
+        activity = self.get_object()
+        return gpx_response(activity_to_gpx_chunks(activity), activity.name)
 
     @action(detail=False, methods=['POST'], name='Import GPX')
     def import_gpx(self, request):
@@ -105,7 +122,8 @@ class ActivityViewSet(ModelViewSet):
             raise ValidationError(
                 'Invalid activity. Please use a previously exported GPX file containing the activity.')
 
-        serializer = self.get_serializer(activity, many=False)
+        queryset = prefetch_activity_graph(Activity.objects).get(id=activity.id)
+        serializer = self.get_serializer(queryset, many=False)
         return Response(serializer.data)
 
 
@@ -113,6 +131,21 @@ class WaypointGroupViewSet(ModelViewSet):
     queryset = WaypointGroup.objects.all()
     serializer_class = WaypointGroupSerializer
 
+    @action(detail=True, methods=['POST'], name='Reorder Waypoints')
+    def reorder(self, request, pk=None):
+        group: WaypointGroup = self.get_object()
+        if group.type != WaypointGroupType.ORDERED:
+            raise ValidationError('Only waypoints of an ordered group can be reordered')
+
+        try:
+            waypoint_ids = [uuid.UUID(str(id)) for id in request.data.get('waypoints', [])]
+            reorder_waypoints(group, waypoint_ids)
+        except ValueError as e:
+            raise ValidationError(str(e))
+
+        serializer = self.get_serializer(group)
+        return Response(serializer.data)
+
 
 class WaypointViewSet(ModelViewSet):
     queryset = Waypoint.objects.all()
@@ -178,28 +211,16 @@ class WaypointViewSet(ModelViewSet):
             return
 
         if updated_index < 0:
-            raise APIException("Waypoint index cannot be lower than 0")
-
-        if abs(current_index - updated_index) != 1:
-            raise APIException("At the moment a waypoint index can only be increased or decreased by 1")
-
-        other_waypoint = Waypoint.objects.get(group=group, index=updated_index)
+            raise ValidationError("Waypoint index cannot be lower than 0")
 
-        if other_waypoint == None:
-            serializer.save()
-            self.saveMedia(serializer=serializer)
-        else:
-            # Swap between waypoint indexes
-            # Temporarily set the other waypoint to -1 to avoid the error:
-            # django.db.utils.IntegrityError: duplicate key value violates unique constraint "unique_group_index"
-            other_waypoint.index = -1
-            other_waypoint.save()
-
-            serializer.save()
-            self.saveMedia(serializer=serializer)
+        if updated_index >= group.waypoints.count():
+            raise ValidationError("Waypoint index cannot be greater than the last waypoint index")
 
-            other_waypoint.index = current_index
-            other_waypoint.save()
+        # Move the waypoint, shifting the waypoints in between, then save the
+        # rest of the changes
+        move_waypoint(serializer.instance, updated_index)
+        serializer.save()
+        self.saveMedia(serializer=serializer)
 
     def perform_destroy(self, instance):
         group: WaypointGroup = instance.group
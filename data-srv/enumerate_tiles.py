@@ -3,30 +3,26 @@
 the region. Should correctly handle irregular polygons, i.e. not a simple
 rectangular bounding box. Output can be fed into make_static_tiles.py to
 create z/x/y.json files in bulk.
+
+By default tiles are found by descending a quadtree from zoom 0: tiles
+entirely inside the region emit all of their descendants without further
+tests, and only tiles on the region's boundary are subdivided. Tiles are
+printed as they are found, in quadtree order. --order column instead tests
+every tile of the region's bounding box and prints them column by column.
+
+With --dsn, only tiles that some feature in the tile source tables overlaps
+are printed (column by column), so tiles that soundscape_tile would return
+empty are never generated:
+
+  $ python3 enumerate_tiles.py --dsn "host=localhost dbname=osm" 16 region.poly
 """
 import argparse
-import math
 
+import numpy as np
+import psycopg2
 import shapely
-from shapely import Polygon
-
 
-# standard tile to coordinates and reverse versions from
-# https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
-
-# This returns the NW-corner of the square. Use the function with xtile+1 and/or ytile+1 to get the other corners. With xtile+0.5 & ytile+0.5 it will return the center of the tile.
-def num2deg(xtile, ytile, zoom):
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
+import tilemath
 
 
 # code copied from https://wiki.openstreetmap.org/wiki/Osmosis/Polygon_Filter_File_Python_Parsing
@@ -79,33 +75,155 @@ def parse_poly(lines):
 
 
 # based on https://gist.github.com/devdattaT/dd218d1ecdf6100bcf15
-#get the range of tiles that intersect with the bounding box of the polygon	
+#get the range of tiles that intersect with the bounding box of the polygon
 def getTileRange(polygon, zoom):
-	(xm, ym, xmx, ymx) = polygon.bounds
-	starting = deg2num(ymx, xm, zoom)
-	ending = deg2num(ym, xmx, zoom) # this will be the tiles containing the ending
-	x_range = (starting[0], ending[0])
-	y_range = (starting[1], ending[1])
-	return (x_range, y_range)
+    return tilemath.tile_range(*polygon.bounds, zoom)
+
+
+def enumerate_tiles(polygon, zoom):
+    """Yield (x, y) for every tile intersecting polygon, column by column.
+
+    The tile rows of a column are tested as one array of boxes against the
+    prepared polygon, rather than building one Polygon per tile."""
+    shapely.prepare(polygon)
+    (x_lo, x_hi), (y_lo, y_hi) = getTileRange(polygon, zoom)
+
+    # every column spans the same rows, so their latitudes are shared
+    ys = np.arange(y_lo, y_hi + 1)
+    (_, south, _, north) = tilemath.tile_bbox(x_lo, ys, zoom)
+
+    for x in range(x_lo, x_hi + 1):
+        (west, _, east, _) = tilemath.tile_bbox(x, y_lo, zoom)
+        tiles = shapely.box(west, south, east, north)
+        for y in ys[shapely.intersects(polygon, tiles)]:
+            yield (x, int(y))
+
+
+def enumerate_tiles_quadtree(polygon, zoom):
+    """Yield (x, y) for every tile intersecting polygon, in quadtree order.
 
-#to get the tile as a polygon object
-def getTileASpolygon(z,y,x):
-	ymx, xm = num2deg(x, y, z)
-	ym, xmx = num2deg(x + 1, y + 1, z)
-	return Polygon([(xm, ym), (xmx, ym), (xmx, ymx), (xm, ymx)])
+    Yields the same tiles as enumerate_tiles, but only tests tiles on the
+    polygon's boundary at each zoom level. Memory use does not grow with the
+    size of the region."""
+    shapely.prepare(polygon)
+    (x_lo, x_hi), (y_lo, y_hi) = getTileRange(polygon, zoom)
+
+    stack = [(0, 0, 0)]
+    while stack:
+        z, x, y = stack.pop()
+
+        # descendants at the target zoom, limited to the same tile range as
+        # the column enumeration
+        span = 2 ** (zoom - z)
+        dx_lo, dx_hi = max(x * span, x_lo), min((x + 1) * span - 1, x_hi)
+        dy_lo, dy_hi = max(y * span, y_lo), min((y + 1) * span - 1, y_hi)
+        if dx_lo > dx_hi or dy_lo > dy_hi:
+            continue
+
+        tile = shapely.box(*tilemath.tile_bbox(x, y, z))
+        if z == zoom:
+            if shapely.intersects(polygon, tile):
+                yield (x, y)
+        elif shapely.contains(polygon, tile):
+            for tx in range(dx_lo, dx_hi + 1):
+                for ty in range(dy_lo, dy_hi + 1):
+                    yield (tx, ty)
+        elif shapely.intersects(polygon, tile):
+            # pushed in reverse, so children are visited west to east
+            for cx, cy in [(2 * x + 1, 2 * y + 1), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x, 2 * y)]:
+                stack.append((z + 1, cx, cy))
+
+
+# Tiles whose bounding box some feature's bounding box overlaps, using the
+# same filters as soundscape_tile. Feature extents are first reduced to
+# distinct tile ranges, so the many small features sharing a tile are only
+# expanded once. Ranges include tiles that an extent merely touches, as &&
+# does in soundscape_tile.
+occupied_tiles_query = """
+    WITH features AS (
+        SELECT geometry AS geom FROM osm_roads
+            WHERE geometry && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326) AND service != 'parking_aisle'
+        UNION ALL
+        SELECT geometry FROM osm_places
+            WHERE geometry && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326) AND NOT (properties ? 'boundary' AND properties ? 'historic')
+        UNION ALL
+        SELECT geometry FROM osm_entrances WHERE geometry && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)
+        UNION ALL
+        SELECT geom FROM non_osm_data WHERE geom && ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 4326)
+    ), extents AS (
+        SELECT (ST_XMin(geom) + 180.0) / 360.0 * %(n)s AS west,
+               (ST_XMax(geom) + 180.0) / 360.0 * %(n)s AS east,
+               (1.0 - ln(tan(radians(LEAST(ST_YMax(geom), 85.0511))) + 1.0 / cos(radians(LEAST(ST_YMax(geom), 85.0511)))) / pi()) / 2.0 * %(n)s AS north,
+               (1.0 - ln(tan(radians(GREATEST(ST_YMin(geom), -85.0511))) + 1.0 / cos(radians(GREATEST(ST_YMin(geom), -85.0511)))) / pi()) / 2.0 * %(n)s AS south
+        FROM features
+    ), ranges AS (
+        SELECT DISTINCT GREATEST(ceil(west)::int - 1, %(x_lo)s) AS x_lo,
+                        LEAST(floor(east)::int, %(x_hi)s) AS x_hi,
+                        GREATEST(ceil(north)::int - 1, %(y_lo)s) AS y_lo,
+                        LEAST(floor(south)::int, %(y_hi)s) AS y_hi
+        FROM extents
+    )
+    SELECT DISTINCT x, y
+    FROM ranges, generate_series(x_lo, x_hi) AS x, generate_series(y_lo, y_hi) AS y
+    ORDER BY x, y
+"""
+
+def enumerate_occupied_tiles(polygon, zoom, dsn, batch_size=10000):
+    """Yield (x, y) for every tile intersecting polygon that may contain
+    features, column by column.
+
+    Tiles are streamed from a server-side cursor and tested against the
+    polygon a batch at a time."""
+    shapely.prepare(polygon)
+    (x_lo, x_hi), (y_lo, y_hi) = getTileRange(polygon, zoom)
+    n = 2.0 ** zoom
+
+    (xm, ym, xmx, ymx) = polygon.bounds
+    params = {
+        'xmin': xm, 'ymin': ym, 'xmax': xmx, 'ymax': ymx,
+        'n': n,
+        'x_lo': x_lo, 'x_hi': x_hi,
+        'y_lo': y_lo, 'y_hi': y_hi,
+    }
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor(name='occupied_tiles') as cursor:
+            cursor.execute(occupied_tiles_query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                xs, ys = np.array(rows).T
+                tiles = shapely.box(*tilemath.tile_bbox(xs, ys, zoom))
+                inside = shapely.intersects(polygon, tiles)
+                for x, y in zip(xs[inside], ys[inside]):
+                    yield (int(x), int(y))
+    finally:
+        conn.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('zoom', type=int)
     parser.add_argument('poly_file', type=str)
+    parser.add_argument('--order', choices=['quadtree', 'column'],
+                        help='order of the emitted tiles (default: quadtree)')
+    parser.add_argument('--dsn', type=str, help='only emit tiles with features in this database')
     args = parser.parse_args()
 
+    # the database query always emits tiles in column order
+    if args.dsn and args.order:
+        parser.error('--order cannot be combined with --dsn')
+
+    if args.dsn:
+        enumerate_fn = lambda polygon, zoom: enumerate_occupied_tiles(polygon, zoom, args.dsn)
+    elif args.order in (None, 'quadtree'):
+        enumerate_fn = enumerate_tiles_quadtree
+    else:
+        enumerate_fn = enumerate_tiles
+
     with open(args.poly_file) as f:
         bounds_poly = parse_poly(f)
-        (x_lo, x_hi),  (y_lo, y_hi) = getTileRange(bounds_poly, args.zoom)
-        for x in range(x_lo, x_hi + 1):
-            for y in range(y_lo, y_hi + 1):
-                tile = getTileASpolygon(args.zoom, y, x)
-                if bounds_poly.intersects(tile):
-                    print(f"{x},{y},{args.zoom}")
\ No newline at end of file
+        for x, y in enumerate_fn(bounds_poly, args.zoom):
+            print(f"{x},{y},{args.zoom}")
@@ -12,6 +12,7 @@
 import os
 import math
 import time
+import asyncio
 from datetime import datetime
 
 import json
@@ -25,6 +26,8 @@ from psycopg2.extras import NamedTupleCursor
 
 from aiohttp import web
 
+from tileindex import TileIndex
+
 class StatCounter(object):
     def __init__(self, name, help):
         self.name = name
@@ -74,6 +77,7 @@ tilesrv_start = StatCounter('tilesrv_start_count', 'count of times tile server s
 tile_served = StatCounter('tile_served_count', 'count of tiles served')
 tile_exception = StatCounter('tile_exception_count', 'count of tiles requests that ended in exception')
 tile_queryfail = StatCounter('tile_queryfail_count', 'count of tiles requests that experienced query failure')
+tile_empty_skipped = StatCounter('tile_empty_skipped_count', 'count of tiles served from the empty tile index without a query')
 
 tile_querytime = StatHistogram('tile_querytime_seconds', 'histogram of tile query performance', 0.20, 20)
 tile_size = StatHistogram('tile_size', 'histogram of tile size', 1024 * 8, 32)
@@ -96,6 +100,7 @@ metrics = [
     tile_served,
     tile_exception,
     tile_queryfail,
+    tile_empty_skipped,
     tile_querytime,
     tile_size
 ]
@@ -113,6 +118,12 @@ tile_query = """
 
 timeout_set = "set statement_timeout=2000"
 
+# what gentile_async produces for a tile without features
+empty_tile = json.dumps({'type': 'FeatureCollection', 'features': []}, sort_keys=True)
+
+# seconds between checks for a newer empty tile index
+empty_tiles_recheck = 60
+
 def tile_name(zoom, x, y,):
     return '{0}/{1}/{2}.json'.format(zoom, x, y)
 
@@ -160,7 +171,69 @@ async def tile_handler_on_conn(conn, request):
             telemetry_log('request', start, end)
             return web.Response(text=tile_data, content_type='application/json')
 
+def directory_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return None
+
+def newest_expired_tiles(expiredir):
+    # imposm and ingest.py write their lists into one directory per day
+    if expiredir is None or not os.path.isdir(expiredir):
+        return None
+    mtimes = [directory_mtime(os.path.join(expiredir, day)) for day in os.listdir(expiredir)]
+    return max((mtime for mtime in mtimes if mtime is not None), default=None)
+
+def load_empty_tiles(path, expiredir, mtime):
+    # runs in an executor thread, as loading an index and listing the
+    # expired tiles directory both block
+    new_mtime = (directory_mtime(path), newest_expired_tiles(expiredir))
+    if new_mtime == mtime:
+        return (mtime, None)
+    index = TileIndex.load(path)
+    if expiredir:
+        index.discard_expired(expiredir, index.saved_mtime())
+    return (new_mtime, index)
+
+async def reload_empty_tiles(app):
+    # reload the index once make_static_tiles.py has saved a newer one, or
+    # tiles have expired (or the database was reimported) since, as they
+    # may no longer be empty
+    loop = asyncio.get_running_loop()
+    mtime = None
+    while True:
+        try:
+            (mtime, index) = await loop.run_in_executor(None, load_empty_tiles, app['empty_tiles_path'], app['expiredir'], mtime)
+            if index is not None:
+                app['empty_tiles']['index'] = index
+                always_log('loaded {0} empty tiles'.format(len(index)))
+        except Exception as e:
+            always_log('failed to load empty tiles: {0}'.format(e))
+        await asyncio.sleep(empty_tiles_recheck)
+
+async def empty_tiles_context(app):
+    task = asyncio.create_task(reload_empty_tiles(app))
+    yield
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def known_empty_response(request):
+    if 'empty_tiles_path' not in request.app:
+        return None
+    tile = (int(request.match_info['zoom']), int(request.match_info['x']), int(request.match_info['y']))
+    if tile not in request.app['empty_tiles']['index']:
+        return None
+    tile_empty_skipped.inc()
+    tile_served.inc()
+    return web.Response(text=empty_tile, content_type='application/json')
+
 async def tile_handler_no_pooling(request):
+    response = known_empty_response(request)
+    if response:
+        return response
     try:
         async with aiopg.connect(request.app['dsn']) as conn:
             response = await tile_handler_on_conn(conn, request)
@@ -170,6 +243,9 @@ async def tile_handler_no_pooling(request):
         raise
 
 async def tile_handler_pooling(request):
+    response = known_empty_response(request)
+    if response:
+        return response
     try:
         async with request.app['pool'].acquire() as conn:
             always_log('pool: {0}/{1}/{2}'.format(request.app['pool'].minsize, request.app['pool'].size, request.app['pool'].maxsize))
@@ -207,32 +283,6 @@ async def metrics_handler(request):
     tilesrv_metrics_scraped.inc()
     return web.Response(text=metrics_to_string(metrics))
 
-# standard tile to coordinates and reverse versions from
-# https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-def osm_deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
-
-# This returns the NW-corner of the square. Use the function with xtile+1 and/or ytile+1 to get the other corners. With xtile+0.5 & ytile+0.5 it will return the center of the tile.
-def num2deg(xtile, ytile, zoom):
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
-
-def tile_bbox_from_coords(zoom, coord_bbox):
-    (ax, ay) = osm_deg2num(coord_bbox[0], coord_bbox[1], zoom)
-    (bx, by) = osm_deg2num(coord_bbox[2], coord_bbox[3], zoom)
-    tile_minx = min(ax, bx)
-    tile_maxx = max(ax, bx)
-    tile_miny = min(ay, by)
-    tile_maxy = max(ay, by)
-    return (tile_minx, tile_miny, tile_maxx, tile_maxy)
-
 def always_log(s):
     print('{0}: {1}'.format(datetime.now(), s))
 
@@ -249,6 +299,12 @@ async def app_factory():
         app.middlewares.append(logger_middleware)
     app.middlewares.append(error_middleware)
     app['dsn'] = args.dsn
+    if args.empty_tiles:
+        app['empty_tiles_path'] = args.empty_tiles
+        # replaced by reload_empty_tiles, as the app is frozen once started
+        app['empty_tiles'] = {'index': TileIndex(args.empty_tiles)}
+        app['expiredir'] = args.expiredir
+        app.cleanup_ctx.append(empty_tiles_context)
     if connection_pooling:
         app['pool'] = await aiopg.create_pool(app['dsn'], minsize=0, pool_recycle=30*60)
 
@@ -270,6 +326,8 @@ def main():
     parser.add_argument('--dsn', type=str, help='specify dsn', default='dbname=osm')
     parser.add_argument('--verbose', '-v', action='store_true', help='verbose')
     parser.add_argument('--telemetry', action='store_true', help='enable telemetry')
+    parser.add_argument('--empty_tiles', type=str, help='index of tiles known to be empty, written by make_static_tiles.py; regenerate it after the database changes')
+    parser.add_argument('--expiredir', type=str, help='expired tiles directory; tiles listed there since the empty tile index was saved are queried, and the whole index is ignored if the database was reimported since')
 
     args = parser.parse_args()
 
@@ -3,7 +3,11 @@
 
 import csv
 import os
+import queue
+import shutil
 import subprocess
+import threading
+import concurrent.futures
 import argparse
 import json
 from datetime import datetime
@@ -17,7 +21,12 @@ import psycopg2
 from prometheus_client import start_http_server,  Histogram, Gauge
 
 from kubescape import SoundscapeKube
-from ingest_non_osm import import_non_osm_data, provision_non_osm_data_async
+from ingest_fetch import fetch_extracts_async
+from ingest_non_osm import import_non_osm_data, provision_non_osm_data_async, csv_files
+
+# file in the expired tiles directory touched after every full import; the
+# name is shared with tileindex.py, which is not part of the ingest image
+reimport_marker = 'reimported'
 
 # Prometheus metric for event durations
 event_duration = Histogram(
@@ -25,12 +34,54 @@ event_duration = Histogram(
     "Duration of events",
     ["event_name"]
 )
+# Prometheus metric for the import progress of each database
+database_import_stage = Gauge(
+    "database_import_stage",
+    "Import stage of a database: 0 queued, 1 write, 2 rotate, 3 non_osm, 4 maintenance, 5 provision_sql, 6 done, 7 failed",
+    ["database"]
+)
 # Prometheus metric for last event occurrence
 last_event_time = Gauge(
     "event_last_time",
     "Timestamp of last event occurrence",
     ["event_name"]
 )
+# Prometheus metrics for what the last occurrence of an event processed
+event_bytes = Gauge(
+    "event_bytes",
+    "Bytes processed by the last occurrence of an event",
+    ["event_name"]
+)
+event_rows = Gauge(
+    "event_rows",
+    "Rows written by the last occurrence of an event",
+    ["event_name"]
+)
+event_peak_rss = Gauge(
+    "event_peak_rss_bytes",
+    "Peak resident memory of the child process of the last occurrence of an event",
+    ["event_name"]
+)
+# Prometheus metrics for the tile source tables after each import stage
+relation_size = Gauge(
+    "postgis_relation_size_bytes",
+    "Size of a tile source table or of its indexes",
+    ["database", "relation", "kind"]
+)
+relation_rows = Gauge(
+    "postgis_relation_rows",
+    "Live rows in a tile source table",
+    ["database", "relation"]
+)
+
+# Tables read by soundscape_tile
+tile_source_tables = ['osm_roads', 'osm_places', 'osm_entrances', 'non_osm_data']
+
+import_stages = ['queued', 'write', 'rotate', 'non_osm', 'maintenance', 'provision_sql', 'done', 'failed']
+
+# Below this share of all-visible pages, index-only scans on a table still
+# have to visit the heap for most rows
+all_visible_threshold = 0.9
 
 dsn_default_base = 'host=localhost '
 dsn_init_default = dsn_default_base + 'dbname=postgres'
@@ -43,17 +94,23 @@ parser.add_argument('--skipimport', action='store_true', help='skips import task
 parser.add_argument('--updatemodel', type=str, help='choose update model', choices=['imposmauto', 'importloop', 'none'], default='none')
 parser.add_argument('--sourceupdate', action='store_true', help='update source data', default=True)
 parser.add_argument('--telemetry', action='store_true', help='generate telemetry')
+parser.add_argument('--report', type=str, help='JSON file describing the stages of the latest update')
 
 parser.add_argument('--delay', type=int, help='loop delay time', default=60 * 60 * 8)
+parser.add_argument('--rescan_delay', type=int, help='time between checks for update triggers', default=60)
 
 # configuration of files, directories and necessary configuration
 parser.add_argument('--extracts', type=str, default='extracts.json', help='extracts file')
 parser.add_argument('--mapping', type=str, help='mapping file path', default='mapping.yml')
 parser.add_argument('--imposm', type=str, help='imposm executable', default='imposm')
+parser.add_argument('--osmium', type=str, help='osmium executable', default='osmium')
+parser.add_argument('--importmode', type=str, help='how multiple extracts are read', choices=['sequential', 'merge'], default='sequential')
+parser.add_argument('--parallelism', type=int, help='worker threads for osmium and imposm (default: all cores)')
 parser.add_argument('--where', metavar='region', nargs='+', type=str, help='area names')
 parser.add_argument('--cachedir', type=str, help='imposm temp directory', default='/tmp/imposm3')
 parser.add_argument('--diffdir', type=str, help='imposm diff directory', default='/tmp/imposm3_diffdir')
 parser.add_argument('--pbfdir', type=str, help='pbf directory', default='.')
+parser.add_argument('--fetch_per_host', type=int, help='concurrent extract downloads per host', default=2)
 parser.add_argument('--expiredir', type=str, help='expired tiles directory', default='/tmp/imposm3_expiredir')
 parser.add_argument('--extradatadir', type=str, help='CSV containing extra data to import')
 parser.add_argument('--config', type=str, help='config file', default='config.json')
@@ -62,54 +119,47 @@ parser.add_argument('--dsn_init', type=str, help='postgres dsn init', default=ds
 parser.add_argument('--dynamic_db', help='provision databases dynamically', action='store_true', default=False)
 parser.add_argument('--dsn', type=str, help='postgres dsn', default=dsn_default)
 parser.add_argument('--always_update', action='store_true', default=False)
+parser.add_argument('--import_workers', type=int, help='databases imported concurrently', default=1)
 
 parser.add_argument('--verbose', action='store_true', help='verbose')
 
+def tool_environment(config):
+    # imposm (Go) and osmium (libosmium) both size their worker pools from
+    # the environment rather than from a command line flag
+    env = dict(os.environ)
+    if config.parallelism:
+        env['GOMAXPROCS'] = str(config.parallelism)
+        env['OSMIUM_POOL_THREADS'] = str(config.parallelism)
+    return env
+
+def run_tool(config, tool_args):
+    # like subprocess.run(check=True), but waits with wait4 so that the peak
+    # RSS (in bytes) of this particular child can be reported
+    process = subprocess.Popen(tool_args, env=tool_environment(config))
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, tool_args)
+    return rusage.ru_maxrss * 1024
+
+def file_sizes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
 def update_imposmauto(config):
     logger.info('Incremental update - STARTED')
-    subprocess.run([config.imposm, 'run', '-config', config.config, '-mapping', config.mapping, '-connection', config.dsn, '-srid', '4326', '-cachedir', config.cachedir, '-diffdir', config.diffdir, '-expiretiles-dir', config.expiredir, '-expiretiles-zoom', '16'], check=True)
+    run_tool(config, [config.imposm, 'run', '-config', config.config, '-mapping', config.mapping, '-connection', config.dsn, '-srid', '4326', '-cachedir', config.cachedir, '-diffdir', config.diffdir, '-expiretiles-dir', config.expiredir, '-expiretiles-zoom', '16'])
     logger.info('Incremental update - DONE')
 
-def fetch_extract(config, url):
-    #
-    # a local PBF may already be present
-    #
-
-    logger.info('Fetching {0}'.format(url))
-
-    #
-    # N.B. wget won't overwrite data unless it's in timestamp mode
-    #
-
-    local_pbf = os.path.join(config.pbfdir, os.path.basename(url))
-
-    try:
-        before_token = os.path.getmtime(local_pbf)
-    except OSError:
-        before_token = None
-
-    try:
-        subprocess.run(['wget', '-N', url, '--directory-prefix', config.pbfdir], check=True)
-        after_token = os.path.getmtime(local_pbf)
-    except Exception:
-        raise
-
-    logger.info('Fetching {0}: DONE'.format(url))
-    if before_token == after_token:
-        return False
-    else:
-        return True
-
 def fetch_extracts(config, extracts):
     start = datetime.utcnow()
     logger.info('Fetch extracts: START')
-    fetched = False
-    for e in extracts:
-        fetched_extract = fetch_extract(config, e['url'])
-        fetched = fetched or fetched_extract
+    urls = [e['url'] for e in extracts]
+    loop = asyncio.get_event_loop()
+    fetched = loop.run_until_complete(fetch_extracts_async(urls, config.pbfdir, config.fetch_per_host, logger))
     logger.info('Fetch extracts: DONE')
     end = datetime.utcnow()
-    telemetry_log('fetch_extracts', start, end)
+    pbf_bytes = file_sizes([os.path.join(config.pbfdir, pbf) for pbf in extract_pbfs(extracts)]) if fetched else 0
+    telemetry_log('fetch_extracts', start, end, measures={'bytes': pbf_bytes})
     return fetched
 
 def import_extract(config, pbf, cache, incremental):
@@ -118,52 +168,106 @@ def import_extract(config, pbf, cache, incremental):
     imposm_args = [config.imposm, 'import', '-mapping', config.mapping, '-read', config.pbfdir + "/" + pbf, '-srid', '4326', cache, '-cachedir', config.cachedir]
     if incremental:
         imposm_args.extend(['-diff', '-diffdir', config.diffdir])
-    subprocess.run(imposm_args, check=True)
+    peak_rss = run_tool(config, imposm_args)
     end = datetime.utcnow()
-    telemetry_log('import_extract', start, end)
+    telemetry_log('import_extract', start, end, {'pbf': pbf},
+                  {'bytes': file_sizes([os.path.join(config.pbfdir, pbf)]), 'peak_rss': peak_rss})
     logger.info('import of {0}: DONE'.format(pbf))
 
-def import_write(config, incremental):
+def import_write(config, dsn, cachedir, incremental):
     logger.info('writing of OSM tables: START')
     start = datetime.utcnow()
-    imposm_args = [config.imposm, 'import', '-mapping', config.mapping, '-write', '-connection', config.dsn, '-srid', '4326', '-cachedir', config.cachedir]
+    imposm_args = [config.imposm, 'import', '-mapping', config.mapping, '-write', '-connection', dsn, '-srid', '4326', '-cachedir', cachedir]
     if incremental:
         imposm_args.extend(['-diff', '-diffdir', config.diffdir])
-    subprocess.run(imposm_args, check=True)
+    peak_rss = run_tool(config, imposm_args)
     end = datetime.utcnow()
-    telemetry_log('import_write', start, end, {'dsn': config.dsn})
+    telemetry_log('import_write', start, end, {'dsn': dsn}, {'peak_rss': peak_rss})
     logger.info('Write of OSM tables: DONE')
 
-def import_rotate(config, incremental):
+def import_rotate(config, dsn, cachedir, incremental):
     logger.info('Table rotation: START')
     start = datetime.utcnow()
-    imposm_args = [config.imposm, 'import', '-mapping', config.mapping, '-connection', config.dsn, '-srid', '4326', '-deployproduction', '-cachedir', config.cachedir]
+    imposm_args = [config.imposm, 'import', '-mapping', config.mapping, '-connection', dsn, '-srid', '4326', '-deployproduction', '-cachedir', cachedir]
 
     if incremental:
         imposm_args.extend(['-diff', '-diffdir', config.diffdir])
-    subprocess.run(imposm_args, check=True)
+    peak_rss = run_tool(config, imposm_args)
     end = datetime.utcnow()
-    telemetry_log('import_rotate', start, end, {'dsn': config.dsn})
+    telemetry_log('import_rotate', start, end, {'dsn': dsn}, {'peak_rss': peak_rss})
     logger.info('Table rotation: DONE')
+    if not incremental:
+        write_reimport_marker(config)
+
+def extract_pbfs(extracts):
+    pbfs = []
+    for e in extracts:
+        urlbits = urllib.parse.urlsplit(e['url'])
+        pbf = os.path.basename(urlbits.path)
+        if pbf not in pbfs:
+            pbfs.append(pbf)
+    return pbfs
+
+def merge_extracts(config, pbfs):
+    #
+    # osmium streams all of the (sorted) extracts in a single pass and drops
+    # objects duplicated where extracts overlap, so imposm only has to read
+    # one file into one cache
+    #
+
+    merged_pbf = 'merged-extracts.osm.pbf'
+    logger.info('Merge of {0} extracts: START'.format(len(pbfs)))
+    start = datetime.utcnow()
+    osmium_args = [config.osmium, 'merge', '--overwrite', '--output', os.path.join(config.pbfdir, merged_pbf)]
+    pbf_paths = [os.path.join(config.pbfdir, pbf) for pbf in pbfs]
+    osmium_args.extend(pbf_paths)
+    peak_rss = run_tool(config, osmium_args)
+    end = datetime.utcnow()
+    telemetry_log('merge_extracts', start, end, measures={'bytes': file_sizes(pbf_paths), 'peak_rss': peak_rss})
+    logger.info('Merge of {0} extracts: DONE'.format(len(pbfs)))
+    return merged_pbf
 
 def import_extracts(config, extracts, incremental):
-    imported = {}
-    for e, i in zip(extracts, range(len(extracts))):
+    pbfs = extract_pbfs(extracts)
+    if config.importmode == 'merge' and len(pbfs) > 1:
+        pbfs = [merge_extracts(config, pbfs)]
+
+    for pbf, i in zip(pbfs, range(len(pbfs))):
         if i == 0:
             cache = '-overwritecache'
         else:
             cache = '-appendcache'
-        urlbits = urllib.parse.urlsplit(e['url'])
-        pbf = os.path.basename(urlbits.path)
-        if pbf in imported:
-            continue
-        imported[pbf] = True
         import_extract(config, pbf, cache, incremental)
 
+def write_expired_tiles(config, tiles, zoom):
+    # same layout as the tile lists imposm writes with -expiretiles-dir, so
+    # whatever consumes those also invalidates tiles changed outside OSM
+    if len(tiles) == 0:
+        return
+    start = now = datetime.utcnow()
+    expire_dir = os.path.join(config.expiredir, now.strftime('%Y%m%d'))
+    os.makedirs(expire_dir, exist_ok=True)
+    expire_path = os.path.join(expire_dir, now.strftime('%H%M%S.%f') + '-non-osm.tiles')
+    with open(expire_path, 'w') as f:
+        for x, y in sorted(tiles):
+            f.write('{0}/{1}/{2}\n'.format(zoom, x, y))
+    end = datetime.utcnow()
+    telemetry_log('write_expired_tiles', start, end, measures={'rows': len(tiles), 'bytes': file_sizes([expire_path])})
+    logger.info('Wrote {0} expired tiles to {1}'.format(len(tiles), expire_path))
+
+def write_reimport_marker(config):
+    # a full import replaces every table without writing expired tile lists,
+    # so tell the empty tile indexes (see tileindex.py) that they are stale
+    os.makedirs(config.expiredir, exist_ok=True)
+    marker_path = os.path.join(config.expiredir, reimport_marker)
+    with open(marker_path, 'w') as f:
+        f.write(datetime.utcnow().isoformat() + '\n')
+    logger.info('Marked tiles before now as expired in {0}'.format(marker_path))
+
 def import_extracts_and_write(config, extracts, incremental):
     import_extracts(config, extracts, incremental)
-    import_write(config, incremental)
-    import_rotate(config, incremental)
+    import_write(config, config.dsn, config.cachedir, incremental)
+    import_rotate(config, config.dsn, config.cachedir, incremental)
 
 async def provision_database_async(postgres_dsn, osm_dsn):
     async with aiopg.connect(dsn=postgres_dsn) as conn:
@@ -199,14 +303,213 @@ def provision_database(postgres_dsn, osm_dsn):
     telemetry_log('provision_database', start, end, {'dsn': postgres_dsn})
 
 def provision_database_soundscape(osm_dsn):
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(provision_database_soundscape_async(osm_dsn))
+    start = datetime.utcnow()
+    # N.B. called from import worker threads, which have no event loop
+    asyncio.run(provision_database_soundscape_async(osm_dsn))
+    end = datetime.utcnow()
+    ingest_path = os.environ['INGEST']
+    sql_bytes = file_sizes([os.path.join(ingest_path, 'postgis-vt-util.sql'), os.path.join(ingest_path, 'tilefunc.sql')])
+    telemetry_log('provision_database_soundscape', start, end, measures={'bytes': sql_bytes})
 
-def execute_kube_updatemodel_provision_and_import(config, updated):
-    namespace = os.environ['NAMESPACE']
-    kube = SoundscapeKube(None, namespace)
-    kube.connect()
+def import_non_osm(config, d):
+    start = datetime.utcnow()
+    tiles, rows = import_non_osm_data(config.extradatadir, d['dsn2'], logger)
+    end = datetime.utcnow()
+    csv_bytes = file_sizes([os.path.join(config.extradatadir, f) for f in csv_files(config.extradatadir)])
+    telemetry_log('import_non_osm', start, end, {'database': d['name']}, {'bytes': csv_bytes, 'rows': rows})
+    write_expired_tiles(config, tiles, 16)
+
+def maintain_database(d, vacuum_tables, analyze_tables):
+    #
+    # Freshly rotated or reloaded tables have no planner statistics and an
+    # empty visibility map, which makes for bad tile query plans and rules
+    # out index-only scans until autovacuum gets around to them.
+    #
+
+    start = datetime.utcnow()
+    logger.info('Maintenance of "{0}": START'.format(d['name']))
+    conn = psycopg2.connect(d['dsn2'])
+    # N.B. VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT c.relname FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'public' AND c.relkind = 'r' AND c.relname = ANY(%s)""",
+                (vacuum_tables + analyze_tables,)
+            )
+            existing = set(relname for (relname,) in cursor.fetchall())
+
+            for table in vacuum_tables + analyze_tables:
+                if table not in existing:
+                    continue
+                table_start = datetime.utcnow()
+                if table in vacuum_tables:
+                    cursor.execute('VACUUM (ANALYZE) {0}'.format(table))
+                    event_name = 'vacuum_analyze_' + table
+                else:
+                    cursor.execute('ANALYZE {0}'.format(table))
+                    event_name = 'analyze_' + table
+                table_end = datetime.utcnow()
+                telemetry_log(event_name, table_start, table_end, {'database': d['name']})
+                logger.info('{0} of "{1}": {2}s'.format(event_name, d['name'], (table_end - table_start).total_seconds()))
+
+            # index-only scans only skip the heap for all-visible pages
+            cursor.execute(
+                """SELECT c.relname, c.relpages, c.relallvisible FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                WHERE n.nspname = 'public' AND c.relname = ANY(%s)""",
+                (vacuum_tables,)
+            )
+            for relname, relpages, relallvisible in cursor.fetchall():
+                all_visible = relallvisible / relpages if relpages > 0 else 1.0
+                if all_visible < all_visible_threshold:
+                    logger.warning('Maintenance of "{0}": only {1:.0%} of {2} is all-visible, index-only scans will visit the heap'.format(d['name'], all_visible, relname))
+    finally:
+        conn.close()
+    end = datetime.utcnow()
+    telemetry_log('maintain_database', start, end, {'database': d['name']})
+    logger.info('Maintenance of "{0}": DONE'.format(d['name']))
 
+def measure_relations(dsn, schema):
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT c.relname, pg_table_size(c.oid), pg_indexes_size(c.oid), COALESCE(s.n_live_tup, 0)
+                FROM pg_class c
+                JOIN pg_namespace n ON n.oid = c.relnamespace
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+                WHERE n.nspname = %s AND c.relkind = 'r' AND c.relname = ANY(%s)""",
+                (schema, tile_source_tables)
+            )
+            return {
+                relname: {'table_bytes': table_bytes, 'index_bytes': index_bytes, 'rows': rows}
+                for relname, table_bytes, index_bytes, rows in cursor.fetchall()
+            }
+    finally:
+        conn.close()
+
+def record_relations(d, stage, schema='public'):
+    # costs a database connection, so only when someone is looking
+    if not args.telemetry and not args.report:
+        return
+    try:
+        relations = measure_relations(d['dsn2'], schema)
+    except Exception as e:
+        logger.warning('failed measuring tables in "{0}": {1}'.format(d['name'], e))
+        return
+
+    if args.telemetry:
+        for relname, sizes in relations.items():
+            relation = '{0}.{1}'.format(schema, relname)
+            relation_size.labels(d['name'], relation, 'table').set(sizes['table_bytes'])
+            relation_size.labels(d['name'], relation, 'index').set(sizes['index_bytes'])
+            relation_rows.labels(d['name'], relation).set(sizes['rows'])
+    run_report.add_relations(d['name'], stage, schema, relations)
+
+def report_import_stage(d, stage):
+    logger.info('Importing to "{0}": {1}'.format(d['name'], stage))
+    if args.telemetry:
+        database_import_stage.labels(d['name']).set(import_stages.index(stage))
+
+def snapshot_cache(cachedir, snapshot_dir):
+    #
+    # imposm's LevelDB caches are locked by the process using them, so each
+    # concurrent write needs a cache of its own. LevelDB never modifies a
+    # table file once written, so those are shared through hard links and
+    # only the small bookkeeping files (manifest, log, lock) are copied.
+    #
+
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    for root, dirs, files in os.walk(cachedir):
+        snapshot_root = os.path.join(snapshot_dir, os.path.relpath(root, cachedir))
+        os.makedirs(snapshot_root, exist_ok=True)
+        for name in files:
+            if name == 'LOCK':
+                continue
+            if name.endswith('.ldb') or name.endswith('.sst'):
+                os.link(os.path.join(root, name), os.path.join(snapshot_root, name))
+            else:
+                shutil.copy2(os.path.join(root, name), os.path.join(snapshot_root, name))
+
+def import_database(config, kube, kube_lock, d, cachedir):
+    start = datetime.utcnow()
+    try:
+        dsn = kube.get_url_dsn(d['dsn2']) #+ '?sslmode=require'
+        report_import_stage(d, 'write')
+        import_write(config, dsn, cachedir, False)
+        # imposm writes into the import schema, which rotation makes public
+        record_relations(d, 'write', 'import')
+        report_import_stage(d, 'rotate')
+        import_rotate(config, dsn, cachedir, False)
+        record_relations(d, 'rotate')
+        if config.extradatadir:
+            report_import_stage(d, 'non_osm')
+            import_non_osm(config, d)
+            record_relations(d, 'non_osm')
+        # the database is only marked as having map data once its tables
+        # are ready to serve tiles efficiently
+        report_import_stage(d, 'maintenance')
+        maintain_database(d, ['non_osm_data'], [t for t in tile_source_tables if t != 'non_osm_data'])
+        report_import_stage(d, 'provision_sql')
+        provision_database_soundscape(d['dsn2'])
+        # kubernetes connection may have expired
+        with kube_lock:
+            retry_count = 5
+            while True:
+                if retry_count == 0:
+                    kube.set_database_status(d['name'], 'HASMAPDATA')
+                    break
+                else:
+                    try:
+                        kube.set_database_status(d['name'], 'HASMAPDATA')
+                        break
+                    except Exception as e:
+                        logger.warning('failed provisioning database "{0}: {1}" retrying'.format(d['name'], e))
+                retry_count -= 1
+        report_import_stage(d, 'done')
+        end = datetime.utcnow()
+        telemetry_log('import_database', start, end, {'database': d['name']})
+
+    except Exception as e:
+        report_import_stage(d, 'failed')
+        logger.warning('failed provisioning database "{0}: {1}"'.format(d['name'], e))
+
+def import_databases(config, kube, databases):
+    if len(databases) == 0:
+        return
+
+    workers = max(1, min(config.import_workers, len(databases)))
+    logger.info('Importing to {0} databases with {1} workers'.format(len(databases), workers))
+
+    # every worker takes a cache from the pool for the duration of one import
+    caches = queue.Queue()
+    caches.put(config.cachedir)
+    snapshots = ['{0}.worker{1}'.format(config.cachedir, i) for i in range(1, workers)]
+    kube_lock = threading.Lock()
+
+    def import_with_cache(d):
+        cachedir = caches.get()
+        try:
+            import_database(config, kube, kube_lock, d, cachedir)
+        finally:
+            caches.put(cachedir)
+
+    try:
+        for snapshot in snapshots:
+            snapshot_cache(config.cachedir, snapshot)
+            caches.put(snapshot)
+        for d in databases:
+            report_import_stage(d, 'queued')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(import_with_cache, databases))
+    finally:
+        for snapshot in snapshots:
+            shutil.rmtree(snapshot, ignore_errors=True)
+
+def execute_kube_updatemodel_provision_and_import(config, kube, updated):
     logger.info('Provision and import: START')
     logger.info('Provisioning databases: START')
     for d in kube.enumerate_databases():
@@ -232,6 +535,7 @@ def execute_kube_updatemodel_provision_and_import(config, updated):
         import_extracts(config, osm_extracts, False)
 
     logger.info('Updating databases')
+    databases = []
     for d in kube.enumerate_databases():
         dbstatus = d['dbstatus']
 
@@ -242,33 +546,9 @@ def execute_kube_updatemodel_provision_and_import(config, updated):
             logger.info('Updating databases, skipping \'{0}\''.format(d['name']))
             continue
 
-        try:
-            logger.info('Importing to "{0}"'.format(d['name']))
-            args.dsn = kube.get_url_dsn(d['dsn2']) #+ '?sslmode=require'
-            import_write(config, False)
-            import_rotate(config, False)
-            if config.extradatadir:
-                logger.info('Importing non-OSM data: START')
-                import_non_osm_data(config.extradatadir, d['dsn2'], logger)
-                logger.info('Importing non-OSM data: DONE')
-            provision_database_soundscape(d['dsn2'])
-            # kubernetes connection may have expired
-            retry_count = 5
-            while True:
-                if retry_count == 0:
-                    kube.set_database_status(d['name'], 'HASMAPDATA')
-                    break
-                else:
-                    try:
-                        kube.set_database_status(d['name'], 'HASMAPDATA')
-                        break
-                    except Exception as e:
-                        logger.warning('failed provisioning database "{0}: {1}" retrying'.format(d['name'], e))
-                retry_count -= 1
-            logger.info('imported to "{0}"'.format(d['name']))
+        databases.append(d)
 
-        except Exception as e:
-            logger.warning('failed provisioning database "{0}: {1}"'.format(d['name'], e))
+    import_databases(config, kube, databases)
     logger.info('Completed provision and import')
 
 def execute_kube_sync_deployments(manager, desc):
@@ -312,40 +592,222 @@ def execute_kube_sync_tile_services(config):
 def execute_kube_sync_database_services(config):
     execute_kube_sync_tile_services(config)
 
+def import_non_osm_databases(config, kube):
+    # CSV changes alone only need the non-OSM tables of live databases
+    # brought up to date, not a new OSM import
+    logger.info('Updating non-OSM data: START')
+    for d in kube.enumerate_databases():
+        if d['dbstatus'] != 'HASMAPDATA':
+            continue
+        try:
+            import_non_osm(config, d)
+            maintain_database(d, ['non_osm_data'], [])
+            record_relations(d, 'non_osm')
+        except Exception as e:
+            logger.warning('failed updating non-OSM data in "{0}: {1}"'.format(d['name'], e))
+    logger.info('Updating non-OSM data: DONE')
+
+class UpdateScheduler:
+    """Decides what the update loop has to do on each pass.
+
+    Between passes it only looks at cheap signals: the deadline for the next
+    fetch, the database statuses known to kubernetes, and a listing of the
+    non-OSM CSV directory. A pass with no trigger does no work and opens no
+    database connections.
+
+    Databases left waiting for provisioning or an import (INIT or
+    PROVISIONED) after a failure are retried, first after rescan_delay and
+    then with the delay doubling up to the fetch delay.
+    """
+
+    # statuses of databases which still need provisioning or an import
+    pending_statuses = (None, 'INIT', 'PROVISIONED')
+
+    def __init__(self, config, kube):
+        self.config = config
+        self.kube = kube
+        self.next_fetch = time.monotonic()
+        self.database_statuses = None
+        self.csv_fingerprint = self.directory_fingerprint(config.extradatadir)
+        self.retry_delay = config.rescan_delay
+        self.next_retry = None
+
+    @staticmethod
+    def directory_fingerprint(path):
+        if path is None or not os.path.isdir(path):
+            return None
+        fingerprint = set()
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                st = os.stat(os.path.join(root, name))
+                fingerprint.add((os.path.relpath(os.path.join(root, name), path), st.st_size, st.st_mtime_ns))
+        return frozenset(fingerprint)
+
+    def current_database_statuses(self):
+        return {d['name']: d['dbstatus'] for d in self.kube.enumerate_databases()}
+
+    def triggers(self):
+        triggers = set()
+        if time.monotonic() >= self.next_fetch:
+            triggers.add('fetch')
+
+        # N.B. taken before the pass runs, so that status changes made
+        #      while it runs are seen by the next one
+        database_statuses = self.current_database_statuses()
+        if database_statuses != self.database_statuses:
+            self.database_statuses = database_statuses
+            triggers.add('databases')
+
+        if any(status in self.pending_statuses for status in database_statuses.values()):
+            if self.next_retry is None:
+                self.next_retry = time.monotonic() + self.retry_delay
+            elif time.monotonic() >= self.next_retry:
+                triggers.add('retry')
+                self.retry_delay = min(self.retry_delay * 2, self.config.delay)
+                self.next_retry = time.monotonic() + self.retry_delay
+        else:
+            self.retry_delay = self.config.rescan_delay
+            self.next_retry = None
+
+        csv_fingerprint = self.directory_fingerprint(self.config.extradatadir)
+        if csv_fingerprint != self.csv_fingerprint:
+            self.csv_fingerprint = csv_fingerprint
+            triggers.add('non_osm')
+
+        return triggers
+
+    def fetched(self):
+        self.next_fetch = time.monotonic() + self.config.delay
+
+    def wait(self):
+        time.sleep(max(0, min(self.next_fetch - time.monotonic(), self.config.rescan_delay)))
+
 def execute_kube_updatemodel(config):
     # N.B. launch tile services and metrics for already functioning databases
     #      since import of new data can/will take a while
     if config.dynamic_db:
         execute_kube_sync_database_services(config)
 
-    rescan_delay = 60
+    namespace = os.environ['NAMESPACE']
+    kube = SoundscapeKube(None, namespace)
+    kube.connect()
+
+    scheduler = UpdateScheduler(config, kube)
     initial_import = True
     while True:
-        fetch_delay = config.delay
-        updated = fetch_extracts(config, osm_extracts)
-        if config.always_update:
-            updated = True
-
-        while fetch_delay >= 0:
-            execute_kube_updatemodel_provision_and_import(config, updated or initial_import)
-            updated = False
+        triggers = scheduler.triggers()
+        if len(triggers) == 0:
+            scheduler.wait()
+            continue
+        logger.info('Update triggered by: {0}'.format(', '.join(sorted(triggers))))
+        run_report.start_run(triggers)
+
+        updated = False
+        if 'fetch' in triggers:
+            updated = fetch_extracts(config, osm_extracts) or config.always_update
+            scheduler.fetched()
+
+        full_import = updated or initial_import
+        if full_import or 'databases' in triggers or 'retry' in triggers:
+            execute_kube_updatemodel_provision_and_import(config, kube, full_import)
             initial_import = False
 
             if config.dynamic_db:
                 execute_kube_sync_database_services(config)
 
-            time.sleep(rescan_delay)
-            fetch_delay -= rescan_delay
-        initial_import = False
-
-def telemetry_log(event_name, start, end, extra=None):
+        if 'non_osm' in triggers and config.extradatadir and not full_import:
+            import_non_osm_databases(config, kube)
+
+        run_report.finish_run()
+        scheduler.wait()
+
+class RunReport:
+    """JSON description of one pass of the update loop: every event with its
+    duration and measures, and the table sizes after each import stage. The
+    file is rewritten after every event so a long import can be followed."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.run = None
+
+    def start_run(self, triggers):
+        with self.lock:
+            self.run = {
+                'start': datetime.utcnow().isoformat(),
+                'end': None,
+                'triggers': sorted(triggers),
+                'events': [],
+                'relations': [],
+            }
+        self.write()
+
+    def finish_run(self):
+        with self.lock:
+            if self.run is not None:
+                self.run['end'] = datetime.utcnow().isoformat()
+        self.write()
+
+    def add_event(self, event_name, start, end, extra, measures):
+        with self.lock:
+            if self.run is None:
+                return
+            event = {
+                'event': event_name,
+                'start': start.isoformat(),
+                'end': end.isoformat(),
+                'seconds': (end - start).total_seconds(),
+            }
+            # N.B. never report connection strings, they carry passwords
+            event.update({k: v for k, v in (extra or {}).items() if k != 'dsn'})
+            event.update(measures or {})
+            self.run['events'].append(event)
+        self.write()
+
+    def add_relations(self, database, stage, schema, relations):
+        with self.lock:
+            if self.run is None:
+                return
+            self.run['relations'].append({
+                'database': database,
+                'stage': stage,
+                'schema': schema,
+                'tables': relations,
+            })
+        self.write()
+
+    def write(self):
+        if not self.path:
+            return
+        with self.lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.run, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+def telemetry_log(event_name, start, end, extra=None, measures=None):
     if args.telemetry:
         duration = end - start
         event_duration.labels(event_name).observe(duration.total_seconds())
         last_event_time.labels(event_name).set(end.timestamp())
+        if measures:
+            if 'bytes' in measures:
+                event_bytes.labels(event_name).set(measures['bytes'])
+            if 'rows' in measures:
+                event_rows.labels(event_name).set(measures['rows'])
+            if 'peak_rss' in measures:
+                event_peak_rss.labels(event_name).set(measures['peak_rss'])
+    run_report.add_event(event_name, start, end, extra, measures)
 
 args = parser.parse_args()
 
+# a merge import only runs osmium after the extracts have been fetched, so
+# check for it up front rather than hours into the first import
+if args.importmode == 'merge' and shutil.which(args.osmium) is None:
+    parser.error('--importmode merge needs osmium, but {0} was not found'.format(args.osmium))
+
+run_report = RunReport(args.report)
+
 if args.verbose:
     loglevel = logging.INFO
 else:
@@ -0,0 +1,213 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Defines methods used by ingest.py to download OSM extracts.
+
+Extracts are downloaded concurrently (with a limit on connections per host),
+interrupted downloads are resumed with HTTP range requests, and each extract
+is verified against the .md5 file Geofabrik publishes next to it before it
+replaces the local copy.
+
+If invoked directly, the script downloads the given URLs into a directory,
+which is also a convenient way to exercise it against a local HTTP server:
+
+  $ python3 ingest_fetch.py --pbfdir /tmp/pbf http://localhost:8000/andorra-latest.osm.pbf
+"""
+import os
+import asyncio
+import hashlib
+import argparse
+import logging
+import urllib.parse
+from email.utils import formatdate, parsedate_to_datetime
+
+import aiohttp
+
+chunk_size = 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def local_pbf_path(pbfdir, url):
+    urlbits = urllib.parse.urlsplit(url)
+    return os.path.join(pbfdir, os.path.basename(urlbits.path))
+
+
+def read_text(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def write_text(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def remove_files(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+async def fetch_md5_async(session, url):
+    # Geofabrik publishes "<hexdigest>  <filename>" next to every extract;
+    # other sources may not, in which case we fall back to timestamps.
+    async with session.get(url + '.md5') as response:
+        if response.status != 200:
+            return None
+        text = await response.text()
+    fields = text.split()
+    if len(fields) == 0:
+        return None
+    return fields[0].lower()
+
+
+def range_total(content_range):
+    # "bytes */<total>" or "bytes <first>-<last>/<total>"; the total may be
+    # "*" when the server does not know it
+    if content_range is None:
+        return None
+    total = content_range.rpartition('/')[2].strip()
+    return int(total) if total.isdigit() else None
+
+
+async def download_async(session, url, local_pbf, conditional, logger):
+    partial = local_pbf + '.part'
+    validator_path = partial + '.validator'
+
+    headers = {}
+    offset = 0
+    validator = read_text(validator_path)
+    if os.path.exists(partial) and validator:
+        # If-Range makes the server send the whole file again if it has
+        # changed since the partial download started.
+        offset = os.path.getsize(partial)
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        headers['If-Range'] = validator
+    elif conditional and os.path.exists(local_pbf):
+        # equivalent of wget -N, used when there is no checksum to compare
+        headers['If-Modified-Since'] = formatdate(os.path.getmtime(local_pbf), usegmt=True)
+
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return None
+        if response.status == 416:
+            # the range starts at or past the end of the file: the partial
+            # download is complete if it is exactly the size of the file
+            if range_total(response.headers.get('Content-Range')) == offset:
+                return partial
+            logger.warning('Fetching {0}: discarding partial download of {1} bytes'.format(url, offset))
+            remove_files(partial, validator_path)
+            return await download_async(session, url, local_pbf, False, logger)
+        response.raise_for_status()
+
+        if response.status == 206:
+            logger.info('Resuming {0} at byte {1}'.format(url, offset))
+            mode = 'ab'
+        else:
+            mode = 'wb'
+
+        validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+        if validator:
+            write_text(validator_path, validator)
+        else:
+            remove_files(validator_path)
+
+        last_modified = response.headers.get('Last-Modified')
+        with open(partial, mode) as f:
+            async for chunk in response.content.iter_chunked(chunk_size):
+                f.write(chunk)
+
+    if last_modified:
+        mtime = parsedate_to_datetime(last_modified).timestamp()
+        os.utime(partial, (mtime, mtime))
+    return partial
+
+
+async def fetch_extract_async(session, url, pbfdir, logger):
+    logger.info('Fetching {0}'.format(url))
+
+    local_pbf = local_pbf_path(pbfdir, url)
+    partial = local_pbf + '.part'
+    local_md5_path = local_pbf + '.md5'
+
+    expected_md5 = await fetch_md5_async(session, url)
+    if expected_md5 and os.path.exists(local_pbf) and read_text(local_md5_path) == expected_md5:
+        logger.info('Fetching {0}: UNCHANGED'.format(url))
+        return False
+
+    loop = asyncio.get_event_loop()
+    conditional = expected_md5 is None
+    for attempt in range(2):
+        downloaded = await download_async(session, url, local_pbf, conditional, logger)
+        if downloaded is None:
+            logger.info('Fetching {0}: UNCHANGED'.format(url))
+            return False
+
+        if expected_md5 is None:
+            break
+        actual_md5 = await loop.run_in_executor(None, file_md5, downloaded)
+        if actual_md5 == expected_md5:
+            break
+
+        # a resumed download may have been stitched onto a stale partial;
+        # discard it and start again from zero once
+        logger.warning('Fetching {0}: checksum mismatch ({1} != {2})'.format(url, actual_md5, expected_md5))
+        remove_files(partial, partial + '.validator')
+        conditional = False
+    else:
+        raise ChecksumMismatch(url)
+
+    os.replace(downloaded, local_pbf)
+    remove_files(partial + '.validator')
+    if expected_md5:
+        write_text(local_md5_path, expected_md5)
+    else:
+        remove_files(local_md5_path)
+
+    logger.info('Fetching {0}: DONE'.format(url))
+    return True
+
+
+async def fetch_extracts_async(urls, pbfdir, per_host, logger):
+    # N.B. the connector limit applies to each host separately, so extracts
+    #      from different mirrors download side by side
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=per_host)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        unique_urls = list(dict.fromkeys(urls))
+        results = await asyncio.gather(*[fetch_extract_async(session, url, pbfdir, logger) for url in unique_urls])
+    return any(results)
+
+
+def fetch_extracts(urls, pbfdir, per_host, logger):
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(fetch_extracts_async(urls, pbfdir, per_host, logger))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='download OSM extracts')
+    parser.add_argument('urls', metavar='url', nargs='+', type=str)
+    parser.add_argument('--pbfdir', type=str, default='.')
+    parser.add_argument('--per_host', type=int, default=2)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s:%(levelname)s:%(message)s')
+    fetched = fetch_extracts(args.urls, args.pbfdir, args.per_host, logging.getLogger())
+    print('updated' if fetched else 'unchanged')
@@ -3,18 +3,29 @@
 """
 Defines methods used by ingest.py to populate the non_osm_data table.
 
-If invoked directly, the script will rebuild the non_osm_data table without
-reimporting the whole planet. This still needs to run inside an ingest
-container, e.g.
+Every row remembers the CSV file it came from and a key derived from its
+feature type, value and position. The content hash of every loaded file is
+kept in non_osm_files, so later imports only re-read files which changed and
+only insert, update or delete the rows which differ. Rows keep their
+synthetic OSM IDs for as long as they exist. Each import returns the z16 tiles
+whose contents changed and the number of rows it wrote.
+
+If invoked directly, the script will apply changes to the non_osm_data table
+without reimporting the whole planet (or, with --rebuild, reload it from
+scratch). This still needs to run inside an ingest container, e.g.
 
   $ docker-compose exec ingest python3 /ingest/ingest_non_osm.py
 """
 import os
+import io
 import csv
 import asyncio
+import hashlib
+import argparse
 import logging
 
 import aiopg
+import psycopg2
 
 from kubescape import SoundscapeKube
 
@@ -23,74 +34,422 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger()
 
 
+non_osm_table = 'non_osm_data'
+non_osm_shadow_table = 'non_osm_data_shadow'
+non_osm_old_table = 'non_osm_data_old'
+non_osm_files_table = 'non_osm_files'
+non_osm_state_table = 'non_osm_state'
+
+# The client expects OSM IDs for every point, but this is not OSM data.
+# Assign large positive OSM IDs, which will not conflict with real values.
+# Discussion: https://github.com/soundscape-community/soundscape/pull/135#issuecomment-2665868581
+# IDs come from a sequence which no table owns, so an ID is never reused.
+non_osm_id_sequence = 'non_osm_osm_id_seq'
+non_osm_first_id = 10**17 + 1
+
+# Zoom level of the affected tiles reported by an import
+tile_zoom = 16
+
+# Seconds to wait for tile queries to release non_osm_data before the swap
+# gives up and retries, so that queued tile requests are not held up behind it.
+swap_lock_timeout = 5
+swap_attempts = 10
+
+# slippy map tile of a point, see https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+tile_xy_sql = """
+    floor((ST_X(geom) + 180.0) / 360.0 * 2 ^ {0})::int AS x,
+    floor((1.0 - ln(tan(radians(ST_Y(geom))) + 1.0 / cos(radians(ST_Y(geom)))) / pi()) / 2.0 * 2 ^ {0})::int AS y
+""".format(tile_zoom)
+
+
+def non_osm_table_sql(table):
+    return [
+        """CREATE TABLE IF NOT EXISTS {0} (
+            id BIGSERIAL PRIMARY KEY,
+            osm_id BIGINT,
+            feature_type TEXT,
+            feature_value TEXT,
+            properties HSTORE,
+            geom GEOMETRY(Point, 4326),
+            source_file TEXT,
+            row_key TEXT
+        )""".format(table),
+    ]
+
+
+def non_osm_index_sql(table):
+    return [
+        "CREATE INDEX IF NOT EXISTS {0}_geom_idx ON {0} USING GIST (geom)".format(table),
+        "CREATE UNIQUE INDEX IF NOT EXISTS {0}_row_key_idx ON {0} (source_file, row_key)".format(table),
+    ]
+
+
+def non_osm_schema_sql():
+    return non_osm_table_sql(non_osm_table) + [
+        # tables created before rows were tracked
+        "ALTER TABLE {0} ADD COLUMN IF NOT EXISTS source_file TEXT".format(non_osm_table),
+        "ALTER TABLE {0} ADD COLUMN IF NOT EXISTS row_key TEXT".format(non_osm_table),
+    ] + non_osm_index_sql(non_osm_table) + [
+        "CREATE SEQUENCE IF NOT EXISTS {0} START {1}".format(non_osm_id_sequence, non_osm_first_id),
+        """CREATE TABLE IF NOT EXISTS {0} (
+            source_file TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL
+        )""".format(non_osm_files_table),
+        # one row once non_osm_data has been loaded, even from no files
+        """CREATE TABLE IF NOT EXISTS {0} (
+            loaded TIMESTAMPTZ NOT NULL
+        )""".format(non_osm_state_table),
+    ]
+
+
+def non_osm_schema_ready(cursor):
+    # Checked in the catalog, because the statements of non_osm_schema_sql()
+    # lock non_osm_data even when there is nothing for them to do, and tile
+    # queries would queue up behind them.
+    cursor.execute(
+        """SELECT to_regclass(%(table)s) IS NOT NULL
+            AND to_regclass(%(geom_idx)s) IS NOT NULL
+            AND to_regclass(%(row_key_idx)s) IS NOT NULL
+            AND to_regclass(%(sequence)s) IS NOT NULL
+            AND to_regclass(%(files)s) IS NOT NULL
+            AND to_regclass(%(state)s) IS NOT NULL
+            AND (SELECT count(*) FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = %(table)s
+                AND column_name IN ('source_file', 'row_key')) = 2""",
+        {'table': non_osm_table, 'geom_idx': non_osm_table + '_geom_idx',
+         'row_key_idx': non_osm_table + '_row_key_idx', 'sequence': non_osm_id_sequence,
+         'files': non_osm_files_table, 'state': non_osm_state_table}
+    )
+    (ready,) = cursor.fetchone()
+    return ready
+
+
 async def provision_non_osm_data_async(osm_dsn):
     # Create a table into which we can load extra (non-OSM) data from CSV.
+    # Existing data is left alone; imports apply changes to it.
     async with aiopg.connect(dsn=osm_dsn) as conn:
         cursor = await conn.cursor()
-        await cursor.execute(
-            """CREATE TABLE IF NOT EXISTS non_osm_data (
-                id BIGSERIAL PRIMARY KEY,
-                osm_id BIGINT,
-                feature_type TEXT,
-                feature_value TEXT,
-                properties HSTORE,
-                geom GEOMETRY(Point, 4326)
-            )"""
+        for statement in non_osm_schema_sql():
+            await cursor.execute(statement)
+
+
+def hstore_literal(props):
+    # Text input form of an hstore, e.g. "name"=>"Main St", "note"=>NULL
+    def quote(text):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    return ', '.join(
+        '{0}=>{1}'.format(quote(key), 'NULL' if value is None else quote(value))
+        for key, value in props.items()
+    )
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def csv_files(csv_dir):
+    # names of the CSV files the loader reads, relative to csv_dir
+    return sorted(
+        name for name in os.listdir(csv_dir)
+        if name.lower().endswith('.csv') and os.path.isfile(os.path.join(csv_dir, name))
+    )
+
+
+def csv_file_hashes(csv_dir):
+    return {
+        csv_path: file_sha256(os.path.join(csv_dir, csv_path))
+        for csv_path in csv_files(csv_dir)
+    }
+
+
+def row_key(feat_type, feat_value, long, lat, seen):
+    # A row is identified by what it is and where it is; everything else is
+    # a property which can be updated in place. Identical rows within one
+    # file are told apart by their order of appearance.
+    key = hashlib.sha1('\x1f'.join([feat_type, feat_value, repr(long), repr(lat)]).encode()).hexdigest()
+    seen[key] = seen.get(key, 0) + 1
+    if seen[key] > 1:
+        key = '{0}#{1}'.format(key, seen[key])
+    return key
+
+
+def non_osm_staging_rows(csv_dir, csv_paths, logger):
+    for csv_path in csv_paths:
+        with open(os.path.join(csv_dir, csv_path), encoding="utf8") as f:
+            rowcount = 0
+            seen = {}
+            for row in csv.DictReader(f):
+                rowcount += 1
+
+                # After removing required columns, the remaining fields in
+                # the row will be stored in the item's properties field.
+                feat_type = row.pop("feature_type")
+                feat_value = row.pop('feature_value')
+                long = float(row.pop("longitude"))
+                lat = float(row.pop("latitude"))
+                props = row
+
+                yield (csv_path, row_key(feat_type, feat_value, long, lat, seen), rowcount,
+                       feat_type, feat_value, repr(long), repr(lat), hstore_literal(props))
+
+            logger.info(
+                "Read {0} rows from {1}".format(rowcount, csv_path))
+
+
+class CopyStream:
+    """File-like object that renders rows as CSV on demand for COPY FROM,
+    so that no CSV file is ever held in memory as a whole."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, quoting=csv.QUOTE_ALL)
+        self.pending = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.pending) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.writer.writerow(row)
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        if size < 0:
+            size = len(self.pending)
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        return chunk
+
+
+def stage_non_osm_data(cursor, csv_dir, csv_paths, logger):
+    # Stream the CSV rows into a staging table with COPY, so that changes
+    # can be applied with set-based statements. N.B. QUOTE_ALL keeps empty
+    # strings (e.g. an empty hstore) from being read back as NULL.
+    cursor.execute(
+        """CREATE TEMP TABLE non_osm_staging (
+            source_file TEXT,
+            row_key TEXT,
+            ordinal INTEGER,
+            feature_type TEXT,
+            feature_value TEXT,
+            longitude DOUBLE PRECISION,
+            latitude DOUBLE PRECISION,
+            properties HSTORE,
+            PRIMARY KEY (source_file, row_key)
+        ) ON COMMIT DROP"""
+    )
+    cursor.copy_expert(
+        """COPY non_osm_staging
+        (source_file, row_key, ordinal, feature_type, feature_value, longitude, latitude, properties)
+        FROM STDIN WITH (FORMAT csv)""",
+        CopyStream(non_osm_staging_rows(csv_dir, csv_paths, logger))
+    )
+    cursor.execute("ANALYZE non_osm_staging")
+
+
+def record_file_hashes(cursor, hashes, replace_all):
+    if replace_all:
+        cursor.execute("TRUNCATE {0}".format(non_osm_files_table))
+    else:
+        cursor.execute(
+            "DELETE FROM {0} WHERE NOT (source_file = ANY(%s))".format(non_osm_files_table),
+            (list(hashes.keys()),)
+        )
+    for csv_path, sha256 in hashes.items():
+        cursor.execute(
+            """INSERT INTO {0} (source_file, sha256) VALUES (%s, %s)
+            ON CONFLICT (source_file) DO UPDATE SET sha256 = EXCLUDED.sha256""".format(non_osm_files_table),
+            (csv_path, sha256)
         )
-        # Remove any existing data
-        await cursor.execute("TRUNCATE non_osm_data")
 
 
-async def import_non_osm_data_async(csv_dir, osm_dsn, logger):
-    # The client expects OSM IDs for every point, but this is not OSM data.
-    # Assign large positive OSM IDs, which will not conflict with real values.
-    # Discussion: https://github.com/soundscape-community/soundscape/pull/135#issuecomment-2665868581
-    osm_id = 10**17
+def apply_non_osm_changes(conn, csv_dir, hashes, logger):
+    # Only files whose content changed are read; rows of files which are
+    # gone, or no longer contain them, are deleted. The changes are applied
+    # in one transaction, so tile queries never see a partial update.
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT source_file, sha256 FROM {0}".format(non_osm_files_table))
+        known = dict(cursor.fetchall())
 
-    async with aiopg.connect(dsn=osm_dsn) as conn:
-        cursor = await conn.cursor()
+        changed_files = [f for f, sha256 in hashes.items() if known.get(f) != sha256]
+        removed_files = [f for f in known if f not in hashes]
+        if len(changed_files) == 0 and len(removed_files) == 0:
+            logger.info("Non-OSM data unchanged")
+            return {}, set()
+
+        stage_non_osm_data(cursor, csv_dir, changed_files, logger)
+        cursor.execute(
+            """WITH deleted AS (
+                DELETE FROM {table} d
+                WHERE (d.source_file = ANY(%(files)s) OR d.source_file IS NULL)
+                AND NOT EXISTS (
+                    SELECT 1 FROM non_osm_staging s
+                    WHERE s.source_file = d.source_file AND s.row_key = d.row_key)
+                RETURNING d.geom
+            ), updated AS (
+                UPDATE {table} d SET properties = s.properties
+                FROM non_osm_staging s
+                WHERE s.source_file = d.source_file AND s.row_key = d.row_key
+                AND d.properties IS DISTINCT FROM s.properties
+                RETURNING d.geom
+            ), inserted AS (
+                INSERT INTO {table}
+                (osm_id, feature_type, feature_value, properties, geom, source_file, row_key)
+                SELECT nextval('{sequence}'), feature_type, feature_value, properties,
+                    ST_SetSRID(ST_MakePoint(longitude, latitude), 4326), source_file, row_key
+                FROM non_osm_staging s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {table} d
+                    WHERE d.source_file = s.source_file AND d.row_key = s.row_key)
+                ORDER BY source_file, ordinal
+                RETURNING geom
+            ), changes AS (
+                SELECT 'deleted' AS change, geom FROM deleted
+                UNION ALL SELECT 'updated', geom FROM updated
+                UNION ALL SELECT 'inserted', geom FROM inserted
+            )
+            SELECT change, {tile_xy} FROM changes""".format(
+                table=non_osm_table, sequence=non_osm_id_sequence, tile_xy=tile_xy_sql),
+            {'files': changed_files + removed_files}
+        )
+
+        counts = {}
+        tiles = set()
+        for change, x, y in cursor.fetchall():
+            counts[change] = counts.get(change, 0) + 1
+            tiles.add((x, y))
 
-        # Remove any existing data
-        await cursor.execute("TRUNCATE non_osm_data")
+        record_file_hashes(cursor, hashes, False)
+    conn.commit()
+    return counts, tiles
 
-        for csv_path in os.listdir(csv_dir):
-            with open(os.path.join(csv_dir, csv_path), encoding="utf8") as f:
-                rowcount = 0
-                for row in csv.DictReader(f):
-                    rowcount += 1
-                    osm_id += 1
 
-                    # After removing required columns, the remaining fields in
-                    # the row will be stored in the item's properties field.
-                    feat_type = row.pop("feature_type")
-                    feat_value = row.pop('feature_value')
-                    long = float(row.pop("longitude"))
-                    lat = float(row.pop("latitude"))
-                    props = row
+def build_non_osm_shadow_table(conn, csv_dir, hashes, logger):
+    # Everything here happens on a table tile queries never read, so the
+    # live non_osm_data table stays fully available while it runs. Rows
+    # which already exist keep their OSM IDs.
+    with conn.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {0}".format(non_osm_shadow_table))
+        for statement in non_osm_table_sql(non_osm_shadow_table):
+            cursor.execute(statement)
+        stage_non_osm_data(cursor, csv_dir, list(hashes.keys()), logger)
+        cursor.execute(
+            """INSERT INTO {shadow}
+            (osm_id, feature_type, feature_value, properties, geom, source_file, row_key)
+            SELECT COALESCE(d.osm_id, nextval('{sequence}')), s.feature_type, s.feature_value, s.properties,
+                ST_SetSRID(ST_MakePoint(s.longitude, s.latitude), 4326), s.source_file, s.row_key
+            FROM non_osm_staging s
+            LEFT JOIN {table} d ON d.source_file = s.source_file AND d.row_key = s.row_key
+            ORDER BY s.source_file, s.ordinal""".format(
+                shadow=non_osm_shadow_table, table=non_osm_table, sequence=non_osm_id_sequence)
+        )
+        rowcount = cursor.rowcount
+        # building the indexes once after the load is much cheaper than
+        # maintaining them row by row
+        for statement in non_osm_index_sql(non_osm_shadow_table):
+            cursor.execute(statement)
+        cursor.execute("ANALYZE {0}".format(non_osm_shadow_table))
+
+        # every tile which held an old row or will hold a new one
+        cursor.execute(
+            """SELECT DISTINCT {tile_xy} FROM (
+                SELECT geom FROM {table} UNION ALL SELECT geom FROM {shadow}
+            ) AS changes""".format(tile_xy=tile_xy_sql, table=non_osm_table, shadow=non_osm_shadow_table)
+        )
+        tiles = set(cursor.fetchall())
+    conn.commit()
+    return rowcount, tiles
 
-                    await cursor.execute(
-                        """INSERT INTO non_osm_data
-                        (osm_id, feature_type, feature_value, properties, geom)
-                        VALUES
-                        (%s, %s, %s, %s, ST_SetSRID(ST_MakePoint(%s, %s), 4326))""", (
-                            osm_id, feat_type, feat_value, props, long, lat
-                        )
-                    )
 
-                logger.info(
-                    "Loaded {0} rows from {1}".format(rowcount, csv_path))
+def swap_non_osm_tables(conn, hashes, logger):
+    # Rotate the shadow table into place in one short transaction, the same
+    # way imposm -deployproduction rotates its tables. Tile queries see
+    # either the old or the new data, never an empty table.
+    renames = [
+        "ALTER TABLE {0} RENAME TO {1}".format(non_osm_table, non_osm_old_table),
+        "ALTER TABLE {0} RENAME TO {1}".format(non_osm_shadow_table, non_osm_table),
+        "DROP TABLE {0}".format(non_osm_old_table),
+        "ALTER INDEX {0}_pkey RENAME TO {1}_pkey".format(non_osm_shadow_table, non_osm_table),
+        "ALTER INDEX {0}_geom_idx RENAME TO {1}_geom_idx".format(non_osm_shadow_table, non_osm_table),
+        "ALTER INDEX {0}_row_key_idx RENAME TO {1}_row_key_idx".format(non_osm_shadow_table, non_osm_table),
+        "ALTER SEQUENCE {0}_id_seq RENAME TO {1}_id_seq".format(non_osm_shadow_table, non_osm_table),
+    ]
 
+    for attempt in range(1, swap_attempts + 1):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SET LOCAL lock_timeout = '{0}s'".format(swap_lock_timeout))
+                for statement in renames:
+                    cursor.execute(statement)
+                record_file_hashes(cursor, hashes, True)
+                cursor.execute("DELETE FROM {0}".format(non_osm_state_table))
+                cursor.execute("INSERT INTO {0} (loaded) VALUES (now())".format(non_osm_state_table))
+            conn.commit()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            conn.rollback()
+            logger.warning("Swapping in non_osm_data: lock not available, attempt {0}".format(attempt))
+    raise Exception("Swapping in non_osm_data: FAILED after {0} attempts".format(swap_attempts))
 
-def import_non_osm_data(csv_dir, osm_dsn, logger):
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(import_non_osm_data_async(csv_dir, osm_dsn, logger))
+
+def import_non_osm_data(csv_dir, osm_dsn, logger, rebuild=False):
+    """Brings non_osm_data up to date with the CSV files in csv_dir and
+    returns the set of (x, y) tiles at zoom 16 whose contents changed, along
+    with the number of rows loaded (or inserted, updated and deleted).
+
+    Changes are applied in place, unless this is the first import into the
+    database (or rebuild is set), in which case a shadow table is built and
+    swapped in."""
+
+    # aiopg connections are asynchronous, which psycopg2 does not allow to
+    # COPY, so the loader uses a regular connection.
+    conn = psycopg2.connect(osm_dsn)
+    try:
+        with conn.cursor() as cursor:
+            # normally done when the database is provisioned
+            if not non_osm_schema_ready(cursor):
+                for statement in non_osm_schema_sql():
+                    cursor.execute(statement)
+            # databases loaded before the state table existed only have
+            # their file hashes to show for it
+            cursor.execute(
+                "SELECT EXISTS (SELECT 1 FROM {0}) OR EXISTS (SELECT 1 FROM {1})".format(
+                    non_osm_state_table, non_osm_files_table)
+            )
+            (loaded,) = cursor.fetchone()
+        conn.commit()
+
+        hashes = csv_file_hashes(csv_dir)
+        if rebuild or not loaded:
+            rowcount, tiles = build_non_osm_shadow_table(conn, csv_dir, hashes, logger)
+            swap_non_osm_tables(conn, hashes, logger)
+            logger.info("Loaded {0} rows into non_osm_data".format(rowcount))
+        else:
+            counts, tiles = apply_non_osm_changes(conn, csv_dir, hashes, logger)
+            rowcount = sum(counts.values())
+            logger.info("Applied non-OSM changes: {0}".format(counts))
+    finally:
+        conn.close()
+
+    logger.info("Non-OSM changes affect {0} tiles".format(len(tiles)))
+    return tiles, rowcount
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='non-OSM data loader for Soundscape')
+    parser.add_argument('--rebuild', action='store_true', help='reload every file from scratch', default=False)
+    args = parser.parse_args()
+
     namespace = os.environ['NAMESPACE']
     kube = SoundscapeKube(None, namespace)
     import_non_osm_data(
         csv_dir="/non_osm_data",
         osm_dsn=kube.databases["osm"]["dsn2"],
-        logger=logger
-    )
\ No newline at end of file
+        logger=logger,
+        rebuild=args.rebuild
+    )
@@ -6,7 +6,6 @@ and confirming that the row is served as a feature in the expected tile.
 """
 import argparse
 import csv
-import math
 from pathlib import Path
 import random
 import sys
@@ -14,15 +13,9 @@ from urllib.parse import urljoin
 
 import requests
 
-
-# standard tile to coordinates and reverse versions from
-# https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
-def osm_deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-    return (xtile, ytile)
+# tilemath lives in the data-srv directory above this one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import tilemath
 
 
 if __name__ == "__main__":
@@ -40,7 +33,7 @@ if __name__ == "__main__":
         print(f"Chose feature: {some_row['name']}")
 
         # Determine tile that would contain feature
-        x, y = osm_deg2num(
+        x, y = tilemath.deg2num(
             float(some_row['latitude']), float(some_row["longitude"]), args.zoom)
         url = urljoin(args.tile_server, f"{args.zoom}/{x}/{y}.json")
         print(f"Fetching {url}...")
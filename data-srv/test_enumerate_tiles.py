@@ -0,0 +1,80 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Tests the tile enumeration in enumerate_tiles.py against a small irregular
+region.
+
+  $ python3 -m unittest test_enumerate_tiles
+"""
+import unittest
+
+import shapely
+
+import enumerate_tiles
+import tilemath
+
+# an L-shaped region around Seattle with a hole, in .poly format
+region_poly = """seattle
+1
+   -122.45   47.50
+   -122.20   47.50
+   -122.20   47.58
+   -122.32   47.58
+   -122.32   47.72
+   -122.45   47.72
+   -122.45   47.50
+END
+!2
+   -122.42   47.53
+   -122.36   47.53
+   -122.36   47.56
+   -122.42   47.56
+   -122.42   47.53
+END
+END
+"""
+
+
+def region():
+    return enumerate_tiles.parse_poly(region_poly.splitlines())
+
+
+def tiles_by_polygon(polygon, zoom):
+    # one Polygon per tile of the bounding range, as the script used to do
+    (x_lo, x_hi), (y_lo, y_hi) = enumerate_tiles.getTileRange(polygon, zoom)
+    return [
+        (x, y)
+        for x in range(x_lo, x_hi + 1)
+        for y in range(y_lo, y_hi + 1)
+        if polygon.intersects(shapely.box(*tilemath.tile_bbox(x, y, zoom)))
+    ]
+
+
+class EnumerateTilesTests(unittest.TestCase):
+    def test_parse_poly_keeps_holes(self):
+        polygon = region()
+        self.assertEqual(len(polygon.geoms), 1)
+        self.assertEqual(len(polygon.geoms[0].interiors), 1)
+
+    def test_column_order_matches_per_tile_test(self):
+        polygon = region()
+        for zoom in (10, 14, 16):
+            with self.subTest(zoom=zoom):
+                self.assertEqual(list(enumerate_tiles.enumerate_tiles(polygon, zoom)), tiles_by_polygon(polygon, zoom))
+
+    def test_quadtree_matches_column_order(self):
+        polygon = region()
+        for zoom in (0, 10, 14, 16):
+            with self.subTest(zoom=zoom):
+                quadtree = list(enumerate_tiles.enumerate_tiles_quadtree(polygon, zoom))
+                self.assertEqual(len(quadtree), len(set(quadtree)))
+                self.assertEqual(set(quadtree), set(enumerate_tiles.enumerate_tiles(polygon, zoom)))
+
+    def test_quadtree_streams(self):
+        # the first tile is available before the region has been covered
+        tiles = enumerate_tiles.enumerate_tiles_quadtree(region(), 16)
+        self.assertEqual(len(next(tiles)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Tests ingest_fetch.py against a local aiohttp server standing in for an
+extract mirror.
+
+  $ python3 -m unittest test_ingest_fetch
+"""
+import os
+import hashlib
+import logging
+import tempfile
+import unittest
+from email.utils import formatdate, parsedate_to_datetime
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import ingest_fetch
+
+content = bytes(range(256)) * 1000
+etag = '"extract-1"'
+last_modified = formatdate(1700000000, usegmt=True)
+
+
+class ExtractMirror:
+    def __init__(self, publish_md5=True):
+        self.publish_md5 = publish_md5
+        self.requests = []
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/extract.osm.pbf', self.extract)
+        app.router.add_get('/extract.osm.pbf.md5', self.md5)
+        return app
+
+    async def md5(self, request):
+        if not self.publish_md5:
+            raise web.HTTPNotFound()
+        return web.Response(text='{0}  extract.osm.pbf\n'.format(hashlib.md5(content).hexdigest()))
+
+    async def extract(self, request):
+        self.requests.append(dict(request.headers))
+        headers = {'ETag': etag, 'Last-Modified': last_modified}
+
+        since = request.headers.get('If-Modified-Since')
+        if since and parsedate_to_datetime(since) >= parsedate_to_datetime(last_modified):
+            return web.Response(status=304, headers=headers)
+
+        range_header = request.headers.get('Range')
+        if range_header and request.headers.get('If-Range') == etag:
+            start = int(range_header[len('bytes='):].rstrip('-'))
+            if start >= len(content):
+                headers['Content-Range'] = 'bytes */{0}'.format(len(content))
+                return web.Response(status=416, headers=headers)
+            headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(start, len(content) - 1, len(content))
+            return web.Response(status=206, body=content[start:], headers=headers)
+
+        return web.Response(body=content, headers=headers)
+
+
+class FetchExtractTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.pbfdir = tempfile.TemporaryDirectory()
+        self.local_pbf = os.path.join(self.pbfdir.name, 'extract.osm.pbf')
+        self.partial = self.local_pbf + '.part'
+        self.logger = logging.getLogger('test_ingest_fetch')
+
+    async def asyncTearDown(self):
+        self.pbfdir.cleanup()
+
+    async def fetch(self, mirror):
+        async with TestServer(mirror.app()) as server, aiohttp.ClientSession() as session:
+            url = str(server.make_url('/extract.osm.pbf'))
+            return await ingest_fetch.fetch_extract_async(session, url, self.pbfdir.name, self.logger)
+
+    def write_partial(self, data, validator=etag):
+        with open(self.partial, 'wb') as f:
+            f.write(data)
+        ingest_fetch.write_text(self.partial + '.validator', validator)
+
+    def assertDownloaded(self):
+        with open(self.local_pbf, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertFalse(os.path.exists(self.partial + '.validator'))
+
+    async def test_resumes_partial_download(self):
+        mirror = ExtractMirror()
+        self.write_partial(content[:1000])
+
+        self.assertTrue(await self.fetch(mirror))
+
+        self.assertDownloaded()
+        self.assertEqual(len(mirror.requests), 1)
+        self.assertEqual(mirror.requests[0]['Range'], 'bytes=1000-')
+
+    async def test_unchanged_extract_is_not_downloaded(self):
+        mirror = ExtractMirror(publish_md5=False)
+        with open(self.local_pbf, 'wb') as f:
+            f.write(content)
+        mtime = parsedate_to_datetime(last_modified).timestamp()
+        os.utime(self.local_pbf, (mtime, mtime))
+
+        self.assertFalse(await self.fetch(mirror))
+        self.assertIn('If-Modified-Since', mirror.requests[0])
+
+    async def test_checksum_mismatch_restarts_download(self):
+        mirror = ExtractMirror()
+        # a stale partial that the server resumes, giving a corrupt file
+        self.write_partial(b'\xff' * 1000)
+
+        with self.assertLogs(self.logger, level='WARNING'):
+            self.assertTrue(await self.fetch(mirror))
+
+        self.assertDownloaded()
+        self.assertEqual(len(mirror.requests), 2)
+        self.assertNotIn('Range', mirror.requests[1])
+
+    async def test_oversized_partial_restarts_download(self):
+        mirror = ExtractMirror(publish_md5=False)
+        self.write_partial(content + b'stale')
+
+        with self.assertLogs(self.logger, level='WARNING'):
+            self.assertTrue(await self.fetch(mirror))
+
+        self.assertDownloaded()
+        self.assertEqual(len(mirror.requests), 2)
+
+    async def test_complete_partial_is_kept(self):
+        mirror = ExtractMirror(publish_md5=False)
+        self.write_partial(content)
+
+        self.assertTrue(await self.fetch(mirror))
+
+        self.assertDownloaded()
+        self.assertEqual(len(mirror.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Tests tileindex.py.
+
+  $ python3 -m unittest test_tileindex
+"""
+import os
+import tempfile
+import unittest
+
+from tileindex import TileIndex
+
+
+class TileIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'index')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_missing_index_is_empty(self):
+        index = TileIndex.load(self.path)
+        self.assertFalse(index.exists())
+        self.assertEqual(len(index), 0)
+        self.assertNotIn((16, 1, 2), index)
+
+    def test_added_tiles_are_saved_and_loaded(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 19295, 24635)
+        index.add('16', '19296', '24635')
+        index.add(14, 4823, 6158)
+        self.assertIn((16, 19295, 24635), index)
+        self.assertEqual(index.pending(), 3)
+
+        index.save()
+        self.assertEqual(index.pending(), 0)
+
+        loaded = TileIndex.load(self.path)
+        self.assertEqual(len(loaded), 3)
+        self.assertIn((16, 19296, 24635), loaded)
+        self.assertIn((14, 4823, 6158), loaded)
+        # same x and y at another zoom is another tile
+        self.assertNotIn((15, 19295, 24635), loaded)
+        self.assertNotIn((16, 24635, 19295), loaded)
+        self.assertEqual(sorted(os.listdir(self.path)), ['14.npy', '16.npy'])
+
+    def test_save_merges_with_saved_tiles(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 1, 1)
+        index.save()
+
+        index = TileIndex.load(self.path)
+        index.add(16, 2, 2)
+        index.save()
+
+        loaded = TileIndex.load(self.path)
+        self.assertEqual(len(loaded), 2)
+        self.assertIn((16, 1, 1), loaded)
+
+    def test_discard(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 1, 1)
+        index.add(16, 2, 2)
+        index.save()
+
+        index = TileIndex.load(self.path)
+        index.add(16, 3, 3)
+        index.discard(16, 1, 1)
+        index.discard(16, 3, 3)
+        # tiles that were never added are ignored
+        index.discard(12, 1, 1)
+        self.assertNotIn((16, 1, 1), index)
+        self.assertNotIn((16, 3, 3), index)
+        index.save()
+
+        loaded = TileIndex.load(self.path)
+        self.assertEqual(len(loaded), 1)
+        self.assertIn((16, 2, 2), loaded)
+
+    def test_discard_expired(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 1, 1)
+        index.add(16, 2, 2)
+        index.add(16, 3, 3)
+        index.save()
+
+        expiredir = os.path.join(self.tempdir.name, 'expired')
+        os.makedirs(os.path.join(expiredir, '20240101'))
+        with open(os.path.join(expiredir, '20240101', '120000.000.tiles'), 'w') as f:
+            f.write('16/1/1\n16/3/3\nnot a tile\n')
+        with open(os.path.join(expiredir, '20240101', '110000.000.tiles'), 'w') as f:
+            f.write('16/2/2\n')
+        os.utime(os.path.join(expiredir, '20240101', '110000.000.tiles'), (1000, 1000))
+
+        self.assertEqual(index.discard_expired(expiredir, since=2000), 1)
+        self.assertEqual(len(index), 1)
+        self.assertIn((16, 2, 2), index)
+
+    def test_reimport_discards_older_index(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 1, 1)
+        index.add(14, 1, 1)
+        index.save()
+
+        expiredir = os.path.join(self.tempdir.name, 'expired')
+        os.makedirs(os.path.join(expiredir, '20240101'))
+        with open(os.path.join(expiredir, 'reimported'), 'w') as f:
+            f.write('2024-01-01T12:00:00\n')
+        os.utime(os.path.join(expiredir, 'reimported'), (2000, 2000))
+        # lists from before the reimport are covered by it
+        with open(os.path.join(expiredir, '20240101', '110000.000.tiles'), 'w') as f:
+            f.write('16/2/2\n')
+        os.utime(os.path.join(expiredir, '20240101', '110000.000.tiles'), (1500, 1500))
+
+        self.assertEqual(index.discard_expired(expiredir, since=1000), 0)
+        self.assertEqual(len(index), 0)
+        index.save()
+        self.assertEqual(len(TileIndex.load(self.path)), 0)
+
+        # an index saved after the reimport is kept
+        index.add(16, 1, 1)
+        index.save()
+        index = TileIndex.load(self.path)
+        self.assertEqual(index.discard_expired(expiredir, since=index.saved_mtime()), 0)
+        self.assertIn((16, 1, 1), index)
+
+    def test_clear(self):
+        index = TileIndex.load(self.path)
+        index.add(16, 1, 1)
+        index.save()
+
+        index.clear()
+        self.assertEqual(len(index), 0)
+        self.assertEqual(len(TileIndex.load(self.path)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Tests tilemath.py.
+
+  $ python3 -m unittest test_tilemath
+"""
+import unittest
+
+import numpy as np
+
+import tilemath
+
+
+class TileMathTests(unittest.TestCase):
+    def test_tile_corner_round_trip(self):
+        zoom = 16
+        xs, ys = np.meshgrid(np.arange(19290, 19300), np.arange(24630, 24640))
+        lat, lon = tilemath.num2deg(xs, ys, zoom)
+        # the NW corner is on the tile's edge, so step just inside it
+        x, y = tilemath.deg2num(lat - 1e-9, lon + 1e-9, zoom)
+        np.testing.assert_array_equal(x, xs)
+        np.testing.assert_array_equal(y, ys)
+
+    def test_point_round_trip(self):
+        lat, lon = 47.6062, -122.3321
+        for zoom in range(0, 20):
+            x, y = tilemath.deg2num(lat, lon, zoom)
+            west, south, east, north = tilemath.tile_bbox(x, y, zoom)
+            self.assertTrue(west <= lon < east)
+            self.assertTrue(south < lat <= north)
+
+    def test_scalar_and_array_results_agree(self):
+        lats = np.array([-33.8688, 0.0, 51.5074])
+        lons = np.array([151.2093, 0.0, -0.1278])
+        xs, ys = tilemath.deg2num(lats, lons, 12)
+        for lat, lon, x, y in zip(lats, lons, xs, ys):
+            self.assertEqual(tilemath.deg2num(float(lat), float(lon), 12), (x, y))
+        self.assertIsInstance(tilemath.deg2num(0.0, 0.0, 12)[0], int)
+
+    def test_tile_range_covers_bbox(self):
+        (x_lo, x_hi), (y_lo, y_hi) = tilemath.tile_range(-122.4, 47.5, -122.2, 47.7, 14)
+        self.assertEqual((x_lo, y_lo), tilemath.deg2num(47.7, -122.4, 14))
+        self.assertEqual((x_hi, y_hi), tilemath.deg2num(47.5, -122.2, 14))
+        self.assertLess(x_lo, x_hi)
+        self.assertLess(y_lo, y_hi)
+
+    def test_quadkey_round_trip(self):
+        self.assertEqual(tilemath.quadkey(3, 5, 3), '213')
+        xs = np.arange(0, 64, 7)
+        ys = np.arange(63, -1, -7)
+        for x, y, key in zip(xs, ys, tilemath.quadkey(xs, ys, 6)):
+            self.assertEqual(tilemath.quadkey_to_tile(key), (x, y, 6))
+        self.assertEqual(tilemath.quadkey(0, 0, 0), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
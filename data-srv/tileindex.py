@@ -0,0 +1,145 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+A compact on-disk set of tiles, used to remember which tiles have already
+been generated without touching the tiles themselves.
+
+An index is a directory holding one <zoom>.npy file per zoom level, each a
+sorted array of tile ids (y << zoom | x). Tiles added since the index was
+loaded are kept in memory until save(), which merges them in and replaces
+each file atomically, so a reader never sees a partially written index.
+
+Tiles whose data changed can be dropped again with discard_expired(), which
+reads the z/x/y tile lists that imposm (and ingest.py, for non-OSM data)
+write to the expired tiles directory. A full import writes no such lists, so
+ingest.py touches a marker file there instead, and an index saved before the
+marker is discarded as a whole.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+
+# touched in the expired tiles directory by ingest.py after a full import
+reimport_marker = 'reimported'
+
+
+def tile_id(zoom, x, y):
+    return (int(y) << int(zoom)) | int(x)
+
+
+class TileIndex:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.saved = {}
+        self.added = {}
+        # zooms with saved ids removed since the index was loaded
+        self.discarded = set()
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        if index.path.is_dir():
+            for entry in index.path.iterdir():
+                if entry.suffix == '.npy' and entry.stem.isdigit():
+                    index.saved[int(entry.stem)] = np.load(entry)
+        return index
+
+    def exists(self):
+        return self.path.is_dir()
+
+    def __contains__(self, tile):
+        (zoom, x, y) = tile
+        zoom = int(zoom)
+        tid = tile_id(zoom, x, y)
+        if tid in self.added.get(zoom, ()):
+            return True
+        ids = self.saved.get(zoom)
+        if ids is None:
+            return False
+        i = np.searchsorted(ids, tid)
+        return bool(i < len(ids) and ids[i] == tid)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.saved.values()) + sum(len(ids) for ids in self.added.values())
+
+    def add(self, zoom, x, y):
+        zoom = int(zoom)
+        self.added.setdefault(zoom, set()).add(tile_id(zoom, x, y))
+
+    def pending(self):
+        return sum(len(ids) for ids in self.added.values())
+
+    def clear(self):
+        """Empty the index, on disk as well."""
+        if self.path.is_dir():
+            for entry in self.path.iterdir():
+                if entry.suffix == '.npy' and entry.stem.isdigit():
+                    entry.unlink()
+        self.saved = {}
+        self.added = {}
+        self.discarded = set()
+
+    def saved_mtime(self):
+        """Modification time of the newest saved zoom file, or None."""
+        mtimes = [entry.stat().st_mtime for entry in self.path.glob('*.npy')] if self.path.is_dir() else []
+        return max(mtimes, default=None)
+
+    def discard(self, zoom, x, y):
+        zoom = int(zoom)
+        tid = tile_id(zoom, x, y)
+        self.added.get(zoom, set()).discard(tid)
+        ids = self.saved.get(zoom)
+        if ids is not None:
+            i = np.searchsorted(ids, tid)
+            if i < len(ids) and ids[i] == tid:
+                self.saved[zoom] = np.delete(ids, i)
+                self.discarded.add(zoom)
+
+    def discard_all(self):
+        """Discard every tile. The saved files are emptied by save()."""
+        self.discarded |= set(self.saved)
+        self.saved = {}
+        self.added = {}
+
+    def discard_expired(self, expiredir, since=None):
+        """Discard every tile listed in the *.tiles files under expiredir
+        modified after since (a timestamp), and return how many lists were
+        read. If the database was reimported after since, every tile is
+        discarded, and only the lists written after the reimport are read."""
+        try:
+            reimported = (Path(expiredir) / reimport_marker).stat().st_mtime
+        except FileNotFoundError:
+            reimported = None
+        if reimported is not None and (since is None or reimported > since):
+            self.discard_all()
+            since = reimported
+
+        lists = 0
+        for expire_path in Path(expiredir).glob('**/*.tiles'):
+            if since is not None and expire_path.stat().st_mtime <= since:
+                continue
+            lists += 1
+            with open(expire_path) as f:
+                for line in f:
+                    fields = line.strip().split('/')
+                    if len(fields) == 3 and all(field.isdigit() for field in fields):
+                        self.discard(*fields)
+        return lists
+
+    def save(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        for zoom in set(self.added) | self.discarded:
+            added = self.added.get(zoom, set())
+            new_ids = np.fromiter(added, dtype=np.uint64, count=len(added))
+            ids = np.union1d(self.saved.get(zoom, np.empty(0, dtype=np.uint64)), new_ids)
+            final = self.path / '{0}.npy'.format(zoom)
+            temp = self.path / '{0}.npy.tmp'.format(zoom)
+            with open(temp, 'wb') as f:
+                np.save(f, ids)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, final)
+            self.saved[zoom] = ids
+        self.added = {}
+        self.discarded = set()
@@ -0,0 +1,81 @@
+# Copyright (c) Soundscape Community.
+# Licensed under the MIT License.
+"""
+Slippy map tile math shared by the data-srv scripts.
+
+Every function accepts either scalars or NumPy arrays (zoom included), and
+broadcasts them against each other, so bulk work such as enumerating a
+region or mapping a log of tile requests runs over whole arrays instead of
+one point at a time. Scalar arguments give plain Python numbers back.
+
+See https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames
+"""
+import numpy as np
+
+
+def _unwrap(value):
+    # hand back Python scalars for scalar inputs, so results can go straight
+    # into URLs, JSON and range()
+    if np.ndim(value) == 0:
+        return value.item() if hasattr(value, 'item') else value
+    return value
+
+
+def deg2num(lat_deg, lon_deg, zoom):
+    """Return (xtile, ytile) of the tile containing each point."""
+    lat_rad = np.radians(lat_deg)
+    n = 2.0 ** np.asarray(zoom)
+    xtile = np.floor((np.asarray(lon_deg) + 180.0) / 360.0 * n).astype(np.int64)
+    ytile = np.floor((1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n).astype(np.int64)
+    return (_unwrap(xtile), _unwrap(ytile))
+
+
+def num2deg(xtile, ytile, zoom):
+    """Return (lat, lon) of the NW-corner of each tile.
+
+    Use xtile+1 and/or ytile+1 to get the other corners. With xtile+0.5 &
+    ytile+0.5 it will return the center of the tile."""
+    n = 2.0 ** np.asarray(zoom)
+    lon_deg = np.asarray(xtile) / n * 360.0 - 180.0
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(ytile) / n))))
+    return (_unwrap(lat_deg), _unwrap(lon_deg))
+
+
+def tile_bbox(xtile, ytile, zoom):
+    """Return (west, south, east, north) of each tile, in degrees."""
+    north, west = num2deg(xtile, ytile, zoom)
+    south, east = num2deg(np.asarray(xtile) + 1, np.asarray(ytile) + 1, zoom)
+    return (west, south, east, north)
+
+
+def tile_range(west, south, east, north, zoom):
+    """Return ((x_lo, x_hi), (y_lo, y_hi)), the inclusive range of tiles
+    covering a bounding box."""
+    (x_lo, y_lo) = deg2num(north, west, zoom)
+    (x_hi, y_hi) = deg2num(south, east, zoom)
+    return ((x_lo, x_hi), (y_lo, y_hi))
+
+
+def quadkey(xtile, ytile, zoom):
+    """Return the quadkey of each tile, as used by Bing Maps.
+
+    zoom must be a scalar here, since every quadkey has zoom digits."""
+    xtile, ytile = np.broadcast_arrays(np.asarray(xtile, dtype=np.int64), np.asarray(ytile, dtype=np.int64))
+    if zoom == 0:
+        return _unwrap(np.full(xtile.shape, ''))
+    # one row of digit characters per tile, viewed as one fixed-width string
+    shifts = np.arange(zoom - 1, -1, -1, dtype=np.int64)
+    digits = ((xtile[..., None] >> shifts) & 1) + 2 * ((ytile[..., None] >> shifts) & 1)
+    chars = np.ascontiguousarray((digits + ord('0')).astype(np.uint8))
+    keys = chars.view('S{0}'.format(zoom))[..., 0].astype(str)
+    return _unwrap(keys)
+
+
+def quadkey_to_tile(key):
+    """Return (xtile, ytile, zoom) of a single quadkey."""
+    xtile = ytile = 0
+    for digit in key:
+        digit = int(digit)
+        xtile = (xtile << 1) | (digit & 1)
+        ytile = (ytile << 1) | (digit >> 1)
+    return (xtile, ytile, len(key))
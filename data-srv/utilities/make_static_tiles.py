@@ -2,9 +2,24 @@
 """Reads a stream of "x,y,z" lines from stdin (such as the output of
 enumerate_tiles.py), and generates z/x/y.json tile files to the specified
 output directory.
+
+Tiles that already exist are skipped, so an interrupted run can be resumed.
+Rather than checking for each tile's file, the tiles written so far are
+recorded in a manifest (a tileindex.TileIndex in output_dir/manifest). The
+manifest is saved every --checkpoint tiles and when the run ends; if it is
+missing, it is rebuilt with one scan of the output directory.
+
+Tiles without features are not written, but are recorded in a second index,
+output_dir/empty, so that later runs (and gentiles.py --empty_tiles) skip
+them too. Given --expiredir, tiles listed in expired tile lists written since
+the empty index was last saved are dropped from it and queried again; this
+is how non-OSM changes applied by ingest.py reach it. If ingest.py reimported
+the database since, the whole empty index is dropped. --recheck_empty queries
+every empty tile again and starts a fresh empty index.
 """
 import argparse
 import json
+import os
 from pathlib import Path
 import sys
 
@@ -13,6 +28,10 @@ from psycopg2.extras import NamedTupleCursor
 
 import bz2
 
+# tileindex lives in the data-srv directory above this one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from tileindex import TileIndex
+
 tile_query = """
     SELECT * from soundscape_tile(%(zoom)s, %(tile_x)s, %(tile_y)s)
 """
@@ -29,30 +48,82 @@ def tile(cursor, x, y, zoom):
     return json.dumps(obj, sort_keys=True)
 
 
+def scan_tiles(output_dir, manifest):
+    """Add every z/x/y.json.bz2 file under output_dir to manifest."""
+    for zoom_entry in os.scandir(output_dir):
+        if not (zoom_entry.is_dir() and zoom_entry.name.isdigit()):
+            continue
+        for x_entry in os.scandir(zoom_entry.path):
+            if not (x_entry.is_dir() and x_entry.name.isdigit()):
+                continue
+            for y_entry in os.scandir(x_entry.path):
+                y = y_entry.name[:-len(".json.bz2")]
+                if y_entry.name.endswith(".json.bz2") and y.isdigit():
+                    manifest.add(zoom_entry.name, x_entry.name, y)
+
+
+def write_tile(tile_dir, tile_path, output):
+    # write next to the final path and rename, so a tile is either complete
+    # or absent if the run is interrupted
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = tile_path.with_name(tile_path.name + ".tmp")
+    with bz2.open(temp_path, "w") as f:
+        f.write(output.encode())
+    os.replace(temp_path, tile_path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("output_dir", type=Path)
     parser.add_argument("postgres_dsn", type=str)
+    parser.add_argument("--checkpoint", type=int, default=10000,
+                        help="save the manifest after this many new tiles")
+    parser.add_argument("--recheck_empty", action="store_true",
+                        help="query tiles previously found to be empty")
+    parser.add_argument("--expiredir", type=Path,
+                        help="expired tiles directory of ingest.py/imposm")
     args = parser.parse_args()
 
+    manifest = TileIndex.load(args.output_dir / "manifest")
+    if not manifest.exists():
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+        scan_tiles(args.output_dir, manifest)
+        manifest.save()
+        print(f"Indexed {len(manifest)} existing tiles")
+
+    empty = TileIndex.load(args.output_dir / "empty")
+    if args.recheck_empty:
+        # N.B. zooms with no new empty tiles would otherwise keep their files
+        empty.clear()
+    elif args.expiredir:
+        lists = empty.discard_expired(args.expiredir, empty.saved_mtime())
+        print(f"Applied {lists} expired tile lists to the empty index")
+
     conn = psycopg2.connect(args.postgres_dsn)
     cursor = conn.cursor(cursor_factory=NamedTupleCursor)
 
     total_tiles = 0
     nonempty_tiles = 0
-    for line in sys.stdin:
-        total_tiles += 1
-        x, y, z = line.strip().split(",")
-        tile_dir = args.output_dir / z / x
-        tile_path = tile_dir / f"{y}.json.bz2"
-        if tile_path.exists():
-            continue
-        output = tile(cursor, x, y, z)
-        if output:
-            tile_dir.mkdir(parents=True, exist_ok=True)
-            nonempty_tiles += 1
-            with bz2.open(tile_path, "w") as f:
-                f.write(output.encode())
+    try:
+        for line in sys.stdin:
+            total_tiles += 1
+            x, y, z = line.strip().split(",")
+            if (z, x, y) in manifest or (z, x, y) in empty:
+                continue
+            output = tile(cursor, x, y, z)
+            if output:
+                tile_dir = args.output_dir / z / x
+                write_tile(tile_dir, tile_dir / f"{y}.json.bz2", output)
+                nonempty_tiles += 1
+                manifest.add(z, x, y)
+            else:
+                empty.add(z, x, y)
+            if manifest.pending() + empty.pending() >= args.checkpoint:
+                manifest.save()
+                empty.save()
+    finally:
+        manifest.save()
+        empty.save()
 
     print(f"Tiles in region: {total_tiles}")
     print(f"Tiles with features: {nonempty_tiles}")
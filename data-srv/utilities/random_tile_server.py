@@ -19,12 +19,17 @@ To use as a backend for the app:
    a. You may need to clear cached map tiles under Settings > Troubleshooting.
 """
 import json
-import math
+from pathlib import Path
 import random
+import sys
 
 from aiohttp import web
 from faker import Faker
 
+# tilemath lives in the data-srv directory above this one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import tilemath
+
 fake = Faker()
 # Upper bound for fake OpenStreetMap node IDs
 MAX_OSM_ID = 1 << 40
@@ -32,15 +37,6 @@ MAX_OSM_ID = 1 << 40
 FEATURE_DENSITY = 200
 
 
-# This returns the NW-corner of the square. Use the function with xtile+1 and/or ytile+1 to get the other corners. With xtile+0.5 & ytile+0.5 it will return the center of the tile.
-def num2deg(xtile, ytile, zoom):
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return (lat_deg, lon_deg)
-
-
 def random_feature(lat, lon, osm_id):
     # Create a mixture of normal and Navilens-enabled bus stops
     properties = {}
@@ -69,8 +65,7 @@ def random_feature(lat, lon, osm_id):
 
 def get_tile_data(zoom, x, y):
     # Get lat/lon range of bounding box
-    min_x, min_y = num2deg(x, y, zoom)
-    max_x, max_y = num2deg(x + 1, y + 1, zoom)
+    west, south, east, north = tilemath.tile_bbox(x, y, zoom)
 
     # Generate randomized GeoJSON
     return {
@@ -78,8 +73,8 @@ def get_tile_data(zoom, x, y):
         "features": [
             # Generate a fixed number of random features within the box
             random_feature(
-                lat=random.uniform(min_x, max_x),
-                lon=random.uniform(min_y, max_y),
+                lat=random.uniform(south, north),
+                lon=random.uniform(west, east),
                 osm_id=random.randrange(1, MAX_OSM_ID),
             ) for _ in range(FEATURE_DENSITY)
         ],
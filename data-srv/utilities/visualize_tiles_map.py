@@ -11,18 +11,15 @@
 
 
 import json
-import math
+from pathlib import Path
+import sys
 import pandas as pd
 import folium
 import argparse
 
-# Tile coordinate conversion
-def num2deg(xtile, ytile, zoom):
-    n = 2.0 ** zoom
-    lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
-    return lat_deg, lon_deg
+# tilemath lives in the data-srv directory above this one
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import tilemath
 
 # Parse command-line arguments
 parser = argparse.ArgumentParser(description="Visualize tile request log as interactive map.")
@@ -51,14 +48,14 @@ with open(args.json_file, "r") as f:
                     z = int(parts[1])
                     x = int(parts[2])
                     y = int(parts[3].replace(".json", ""))
-                    lat, lon = num2deg(x, y, z)
-                    rows.append({"ts": ts, "lat": lat, "lon": lon})
+                    rows.append({"ts": ts, "z": z, "x": x, "y": y})
             except Exception:
                 pass
             buffer = ""
 
 # Create DataFrame and preprocess
 df = pd.DataFrame(rows)
+df["lat"], df["lon"] = tilemath.num2deg(df["x"].to_numpy(), df["y"].to_numpy(), df["z"].to_numpy())
 df["coord_key"] = df["lat"].round(6).astype(str) + "," + df["lon"].round(6).astype(str)
 df["count"] = df["coord_key"].map(df["coord_key"].value_counts())
 
@@ -22,8 +22,12 @@ chown -R user:user /app/backend/files
 mkdir -p /app/backend/staticfiles
 chown -R user:user /app/backend/staticfiles
 
-gosu user /venv/bin/python manage.py collectstatic --noinput
-gosu user /venv/bin/python manage.py migrate
+# Services sharing this image (e.g. the publish worker) leave static files
+# and migrations to the web service, rather than migrating alongside it
+if [ "${SKIP_SETUP:-0}" != "1" ]; then
+    gosu user /venv/bin/python manage.py collectstatic --noinput
+    gosu user /venv/bin/python manage.py migrate
+fi
 
 # Execute the main command
 exec gosu user "$@"
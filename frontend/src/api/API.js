@@ -55,6 +55,15 @@ function objectToFormData(object) {
   return formData;
 }
 
+// How often to check on a publish job, and how long to wait for it to
+// finish, in milliseconds
+const publishPollInterval = 1000;
+const publishTimeout = 10 * 60 * 1000;
+
+function wait(milliseconds) {
+  return new Promise((resolve) => setTimeout(resolve, milliseconds));
+}
+
 class API {
 
   // Activities
@@ -124,9 +133,23 @@ class API {
   }
 
   async publishActivity(activityId) {
-    return axios.post(`activities/${activityId}/publish/`).then((data) => {
-      return new Activity(data);
-    });
+    // Publishing runs in the background; wait for the job to finish and
+    // return the published activity
+    const deadline = Date.now() + publishTimeout;
+    let job = await axios.post(`activities/${activityId}/publish/`);
+    while (job.status === 'queued' || job.status === 'running') {
+      if (Date.now() >= deadline) {
+        throw new Error('Publishing is taking too long, please check again later');
+      }
+      await wait(publishPollInterval);
+      job = await axios.get(`activities/${activityId}/publish_status/`);
+    }
+
+    if (job.status === 'failed') {
+      throw new Error(`Publishing failed: ${job.error}`);
+    }
+
+    return this.getActivity(activityId);
   }
 
   // Waypoints
@@ -151,6 +174,10 @@ class API {
     return axios.put(`waypoints/${waypoint.id}/`, object);
   }
 
+  async reorderWaypoints(waypointGroupId, waypointIds) {
+    return axios.post(`waypoint_groups/${waypointGroupId}/reorder/`, { waypoints: waypointIds });
+  }
+
   async deleteWaypoint(waypointId) {
     return axios.delete(`waypoints/${waypointId}/`);
   }